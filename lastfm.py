@@ -29,6 +29,7 @@
 
 import requests
 from user_auth import user_auth
+from sqlhelper import upsert, use_profile
 
 
 class Module:  # Request commands to be used by the module
@@ -104,13 +105,7 @@ def get_lastfm_user(dbc, nick):
 
 
 def set_lastfm_user(dbc, user, nickname):
-    dbc.execute("""
-INSERT OR IGNORE INTO lastfm (irc_nick, lfm_user) VALUES (?, ?);
-""", (nickname, user))
-
-    dbc.execute("""
-UPDATE lastfm SET lfm_user=? WHERE irc_nick=?;
-""", (user, nickname))
+    upsert(dbc, "lastfm", {"irc_nick": nickname}, {"lfm_user": user})
 
 
 def unset_lastfm_user(dbc, nickname):
@@ -141,13 +136,7 @@ def toggle_auth_mode(dbc, nickname):
     elif auth == 1:
         auth = 0
 
-    dbc.execute("""
-INSERT OR IGNORE INTO lastfm (irc_nick, auth) VALUES (?, ?);
-""", (nickname, auth))
-
-    dbc.execute("""
-UPDATE lastfm SET auth=? WHERE irc_nick=?;
-""", (auth, nickname))
+    upsert(dbc, "lastfm", {"irc_nick": nickname}, {"auth": auth})
 
     return auth
 
@@ -303,6 +292,7 @@ dispatch = {
 def main(i, irc):
     botcmd = i.msg.get_botcmd()
 
+    use_profile(i.db_disk)
     dbc = i.db_disk.cursor()
 
     dbc.execute("""
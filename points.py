@@ -21,6 +21,8 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+from sqlhelper import upsert, use_profile
+
 
 class Module:
     irc_commands = ["PRIVMSG"]
@@ -33,15 +35,40 @@ class Module:
     }
 
 
-def set_gnu_linux_points(db, nickname, points):
+db_ready = False
+
+
+def db_init(db):
+    global db_ready
+
+    if db_ready:
+        return
+
+    use_profile(db)
     dbc = db.cursor()
     try:
         dbc.execute("CREATE TABLE IF NOT EXISTS points_gnu_linux "
                     "(nickname TEXT COLLATE NOCASE, points INTEGER);")
-        dbc.execute("INSERT OR IGNORE INTO points_gnu_linux VALUES (?, ?);",
-                    (nickname, points))
-        dbc.execute("UPDATE points_gnu_linux SET points=? WHERE nickname=?;",
-                    (points, nickname))
+        # The table had no key, so every update inserted another row
+        # for the nickname. Keep one row per nickname and make it unique.
+        dbc.execute("DELETE FROM points_gnu_linux WHERE rowid NOT IN "
+                    "(SELECT max(rowid) FROM points_gnu_linux "
+                    "GROUP BY nickname);")
+        dbc.execute("CREATE UNIQUE INDEX IF NOT EXISTS "
+                    "points_gnu_linux_i_nickname "
+                    "ON points_gnu_linux (nickname);")
+        db.commit()
+    finally:
+        dbc.close()
+    db_ready = True
+
+
+def set_gnu_linux_points(db, nickname, points):
+    db_init(db)
+    dbc = db.cursor()
+    try:
+        upsert(dbc, "points_gnu_linux", {"nickname": nickname},
+               {"points": points})
         db.commit()
     finally:
         dbc.close()
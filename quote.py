@@ -23,11 +23,26 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import argparse
+import atexit
+import csv
+import hashlib
+import json
+import random
+import sqlite3
+import string
+import struct
+import threading
+import time
+import uuid
+from itertools import islice
+
 import requests
 
 from irc.message import remove_formatting
 from admin import is_allowed
 from admin import is_bot_owner
+from sqlhelper import connect
 
 
 class Module:
@@ -37,9 +52,9 @@ class Module:
                     "quote-add", "add-quote", "addquote", "quoteadd",
                     "quote_add", "add_quote",
                     # Others
-                    "quote-del", "quote-search",
+                    "quote-del", "quote-search", "quote-stats",
                     "quote-match", "quote-list-mentioned",
-                    "quote-initialize"]
+                    "quote-initialize", "quote-import", "quote-export"]
     manual = {
         "desc": "Saves user quotes and posts them when requested.",
         "bot_commands": {
@@ -61,6 +76,26 @@ class Module:
                 "info": ("Try to match the given text to a quote."
                          " If a quote is found, it is posted.")
             },
+            "quote-search": {
+                "usage": lambda x: (
+                    f"[channels]: {x}quote-search <text> [--page N]"
+                    f" | [queries]: {x}quote-search <#channel> <text>"
+                    f" [--page N]"
+                ),
+                "info": ("Search for quotes matching the given text. The"
+                         " best matches are posted first, use --page to"
+                         " see more results.")
+            },
+            "quote-stats": {
+                "usage": lambda x: (
+                    f"[channels]: {x}quote-stats [nickname]"
+                    f" | [queries]: {x}quote-stats <#channel> [nickname]"
+                ),
+                "info": ("Show the most quoted users, the users that added"
+                         " the most quotes, the most viewed quotes and the"
+                         " quotes added per month. If a nickname is given,"
+                         " show the statistics of that user.")
+            },
             "quote-add": {
                 "usage": lambda x: f"{x}quote-add <nickname> <quote>",
                 "info": "Add a quote to the database."
@@ -80,6 +115,38 @@ class Module:
 
 logo = "\x02quote\x0F"
 
+# Number of random channel ids probed before falling back to the next
+# existing quote. Ids are dense, only quote-del leaves gaps behind.
+random_quote_probes = 5
+
+# quote-search pagination
+search_page_size = 3
+snippet_tokens = 16
+# Keyset of every page seen so far, see quote_search_handler()
+search_pages = {}
+search_pages_max = 64
+search_version = 0  # Incremented when the quotes change
+
+# Quote views are counted in memory and written to the database in
+# batches, see db_flush_views().
+views_flush_interval = 300  # seconds
+views_flush_count = 100
+
+# quote-import / quote-export
+import_batch_size = 10000
+export_fields = ("id", "channel", "quote", "quotee", "added_by", "views",
+                 "added_at")
+
+# Near duplicate detection with MinHash. Every quote gets
+# `minhash_perms' hashes of its character shingles, grouped in bands of
+# `minhash_rows' hashes. Quotes sharing a band are candidates and are
+# compared with the Jaccard similarity of their shingles.
+near_dup_check = True
+near_dup_threshold = 0.7
+shingle_size = 4
+minhash_perms = 16
+minhash_rows = 2
+
 
 def format_quote(q):
     return f"{logo} #{q[0]} (added by {q[3]}): <{q[2]}> {q[1]}"
@@ -90,6 +157,10 @@ def format_quote(q):
 # ====================================================================
 
 def db_init(dbc):
+    # Used by the migrations to compute the hash of the existing quotes
+    dbc.connection.create_function("quote_hash", 1, quote_hash,
+                                   deterministic=True)
+
     dbc.executescript("""
 
     -- TABLES
@@ -110,6 +181,16 @@ def db_init(dbc):
            PRIMARY KEY(id, channel)
     );
 
+    CREATE TABLE IF NOT EXISTS quote_schema (
+           version      INTEGER NOT NULL
+    );
+
+    INSERT INTO quote_schema (version)
+    SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM quote_schema);
+
+
+    -- FTS5
+
     CREATE VIRTUAL TABLE IF NOT EXISTS quote_fts5 USING fts5 (
            id, quote, tokenize = porter
     );
@@ -124,7 +205,7 @@ def db_init(dbc):
     END;
 
     CREATE TRIGGER IF NOT EXISTS quote_fts5_t_update
-    AFTER UPDATE ON quote_quotes
+    AFTER UPDATE OF quote ON quote_quotes
     BEGIN
         UPDATE quote_fts5 SET quote = new.quote WHERE id = old.id;
     END;
@@ -146,28 +227,523 @@ def db_init(dbc):
 
     """)
 
+    db_migrate(dbc)
+    search_pages_invalidate()
+
+
+# Recompute quote_stats from scratch
+db_stats_rebuild_sql = """
+    DELETE FROM quote_stats;
+
+    INSERT INTO quote_stats (channel, kind, key, quotes)
+    SELECT channel, 'total', '', COUNT(*)
+    FROM quote_channels GROUP BY channel;
+
+    INSERT INTO quote_stats (channel, kind, key, quotes)
+    SELECT c.channel, 'quotee', q.quotee, COUNT(*)
+    FROM quote_channels AS c
+    INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+    GROUP BY c.channel, q.quotee;
+
+    INSERT INTO quote_stats (channel, kind, key, quotes)
+    SELECT c.channel, 'added_by', q.added_by, COUNT(*)
+    FROM quote_channels AS c
+    INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+    GROUP BY c.channel, q.added_by;
+
+    INSERT INTO quote_stats (channel, kind, key, quotes)
+    SELECT c.channel, 'month', strftime('%Y-%m', q.added_at, 'unixepoch'),
+           COUNT(*)
+    FROM quote_channels AS c
+    INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+    WHERE q.added_at IS NOT NULL
+    GROUP BY 1, 3;
+"""
+
+
+# Recompute the 'views' rows of quote_stats from scratch
+db_stats_views_sql = """
+    DELETE FROM quote_stats WHERE kind = 'views';
+
+    INSERT INTO quote_stats (channel, kind, key, quotes)
+    SELECT c.channel, 'views', CAST(c.id AS TEXT), q.views
+    FROM quote_channels AS c
+    INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+    WHERE q.views > 0;
+"""
+
+
+def db_migration_fts5_rowid(dbc):
+    """Migration 7: key the default quote_fts5 table by rowid = quote id,
+    so the triggers update and delete by rowid instead of scanning the
+    unindexed `id' column. The external content table already is.
+    """
+    if db_fts5_is_external(dbc):
+        return ""
+
+    return """
+    DROP TRIGGER IF EXISTS quote_fts5_t_insert;
+    DROP TRIGGER IF EXISTS quote_fts5_t_update;
+    DROP TRIGGER IF EXISTS quote_fts5_t_delete;
+    DROP TABLE quote_fts5;
+
+    CREATE VIRTUAL TABLE quote_fts5 USING fts5 (
+           id UNINDEXED, quote, tokenize = porter
+    );
+
+    INSERT INTO quote_fts5 (rowid, id, quote)
+    SELECT id, id, quote FROM quote_quotes;
+
+    CREATE TRIGGER quote_fts5_t_insert
+    AFTER INSERT ON quote_quotes
+    BEGIN
+        INSERT INTO quote_fts5 (rowid, id, quote)
+        VALUES (new.id, new.id, new.quote);
+    END;
+
+    CREATE TRIGGER quote_fts5_t_update
+    AFTER UPDATE OF quote ON quote_quotes
+    BEGIN
+        UPDATE quote_fts5 SET quote = new.quote WHERE rowid = old.id;
+    END;
+
+    CREATE TRIGGER quote_fts5_t_delete
+    AFTER DELETE ON quote_quotes
+    BEGIN
+        DELETE FROM quote_fts5 WHERE rowid = old.id;
+    END;
+    """
+
+
+# Schema migrations. Each script upgrades the schema by one version and
+# is run once, in order, inside its own transaction. Append new scripts
+# to the end of the list, never edit the old ones. A migration that
+# depends on the current layout is a function that returns the script.
+db_migrations = [
+    # 1: Indexes for the quotee, added_by and channel lookups.
+    #    quote_channels_i_quote_id also covers the join from quote_quotes
+    #    to quote_channels so the channel id is read from the index.
+    """
+    DROP INDEX IF EXISTS quote_channels_i_quote_id;
+
+    CREATE INDEX IF NOT EXISTS quote_quotes_i_quotee
+    ON quote_quotes (quotee COLLATE NOCASE);
+
+    CREATE INDEX IF NOT EXISTS quote_quotes_i_added_by
+    ON quote_quotes (added_by COLLATE NOCASE);
+
+    CREATE INDEX quote_channels_i_quote_id
+    ON quote_channels (quote_id, channel COLLATE NOCASE, id);
+
+    CREATE INDEX IF NOT EXISTS quote_channels_i_channel
+    ON quote_channels (channel COLLATE NOCASE, id);
+
+    ANALYZE quote_quotes;
+    ANALYZE quote_channels;
+    """,
+
+    # 2: Only update the FTS5 index when the text of a quote changes and
+    #    not on every view counter update.
+    """
+    DROP TRIGGER IF EXISTS quote_fts5_t_update;
+
+    CREATE TRIGGER quote_fts5_t_update
+    AFTER UPDATE OF quote ON quote_quotes
+    BEGIN
+        UPDATE quote_fts5 SET quote = new.quote WHERE id = old.id;
+    END;
+    """,
+
+    # 3: Per channel counter of the last assigned channel quote id.
+    """
+    CREATE TABLE IF NOT EXISTS quote_channel_seq (
+           channel      TEXT COLLATE NOCASE PRIMARY KEY NOT NULL,
+           id           INTEGER NOT NULL
+    );
+
+    INSERT INTO quote_channel_seq (channel, id)
+    SELECT channel, MAX(id) FROM quote_channels GROUP BY channel;
+    """,
+
+    # 4: Duplicate detection. `hash' is the hash of the normalized
+    #    quote, see quote_hash(). quote_minhash holds the MinHash band
+    #    buckets of each quote, see quote_minhash_buckets(). It is
+    #    filled for the existing quotes by: quote-initialize minhash
+    """
+    ALTER TABLE quote_quotes ADD COLUMN hash INTEGER;
+
+    UPDATE quote_quotes SET hash = quote_hash(quote);
+
+    CREATE INDEX quote_quotes_i_hash ON quote_quotes (hash);
+
+    ANALYZE quote_quotes;
+
+    CREATE TABLE quote_minhash (
+           bucket       INTEGER NOT NULL,
+           quote_id     INTEGER NOT NULL,
+           PRIMARY KEY(bucket, quote_id)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX quote_minhash_i_quote_id ON quote_minhash (quote_id);
+
+    CREATE TRIGGER quote_minhash_t_delete
+    AFTER DELETE ON quote_quotes
+    BEGIN
+        DELETE FROM quote_minhash WHERE quote_id = old.id;
+    END;
+    """,
+
+    # 5: Aggregates for quote-stats, kept up to date by triggers on
+    #    quote_channels. `kind' is one of:
+    #      'total'    : key is ''
+    #      'quotee'   : key is the quotee
+    #      'added_by' : key is the nickname that added the quote
+    #      'month'    : key is YYYY-MM of added_at (new quotes only)
+    """
+    ALTER TABLE quote_quotes ADD COLUMN added_at INTEGER;
+
+    CREATE INDEX quote_quotes_i_views ON quote_quotes (views);
+
+    CREATE TABLE quote_stats (
+           channel      TEXT COLLATE NOCASE NOT NULL,
+           kind         TEXT NOT NULL,
+           key          TEXT COLLATE NOCASE NOT NULL,
+           quotes       INTEGER NOT NULL,
+           PRIMARY KEY(channel, kind, key)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX quote_stats_i_quotes ON quote_stats (channel, kind, quotes);
+
+    """ + db_stats_rebuild_sql + """
+
+    CREATE TRIGGER quote_stats_t_insert
+    AFTER INSERT ON quote_channels
+    BEGIN
+        INSERT INTO quote_stats (channel, kind, key, quotes)
+        SELECT new.channel, 'total', '', 1
+        WHERE true
+        ON CONFLICT (channel, kind, key) DO UPDATE SET quotes = quotes + 1;
+
+        INSERT INTO quote_stats (channel, kind, key, quotes)
+        SELECT new.channel, 'quotee', quotee, 1
+        FROM quote_quotes WHERE id = new.quote_id
+        ON CONFLICT (channel, kind, key) DO UPDATE SET quotes = quotes + 1;
+
+        INSERT INTO quote_stats (channel, kind, key, quotes)
+        SELECT new.channel, 'added_by', added_by, 1
+        FROM quote_quotes WHERE id = new.quote_id
+        ON CONFLICT (channel, kind, key) DO UPDATE SET quotes = quotes + 1;
+
+        INSERT INTO quote_stats (channel, kind, key, quotes)
+        SELECT new.channel, 'month',
+               strftime('%Y-%m', added_at, 'unixepoch'), 1
+        FROM quote_quotes WHERE id = new.quote_id AND added_at IS NOT NULL
+        ON CONFLICT (channel, kind, key) DO UPDATE SET quotes = quotes + 1;
+    END;
+
+    -- BEFORE, because quote_quotes_t_delete_noref removes the quote
+    CREATE TRIGGER quote_stats_t_delete
+    BEFORE DELETE ON quote_channels
+    BEGIN
+        UPDATE quote_stats SET quotes = quotes - 1
+        WHERE channel = old.channel AND kind = 'total' AND key = '';
+
+        UPDATE quote_stats SET quotes = quotes - 1
+        WHERE channel = old.channel AND kind = 'quotee'
+              AND key = (SELECT quotee FROM quote_quotes
+                         WHERE id = old.quote_id);
+
+        UPDATE quote_stats SET quotes = quotes - 1
+        WHERE channel = old.channel AND kind = 'added_by'
+              AND key = (SELECT added_by FROM quote_quotes
+                         WHERE id = old.quote_id);
+
+        UPDATE quote_stats SET quotes = quotes - 1
+        WHERE channel = old.channel AND kind = 'month'
+              AND key = (SELECT strftime('%Y-%m', added_at, 'unixepoch')
+                         FROM quote_quotes WHERE id = old.quote_id);
+    END;
+    """,
+
+    # 6: Per channel view counts in quote_stats, so that the most viewed
+    #    quotes of a channel are read from quote_stats_i_quotes instead
+    #    of walking the views of every channel. `kind' is:
+    #      'views'    : key is the channel quote id, quotes is the views
+    """
+    DROP INDEX quote_quotes_i_views;
+
+    """ + db_stats_views_sql + """
+
+    CREATE TRIGGER quote_stats_t_views
+    AFTER UPDATE OF views ON quote_quotes
+    BEGIN
+        INSERT INTO quote_stats (channel, kind, key, quotes)
+        SELECT channel, 'views', CAST(id AS TEXT), new.views
+        FROM quote_channels WHERE quote_id = new.id AND new.views > 0
+        ON CONFLICT (channel, kind, key) DO UPDATE SET quotes = new.views;
+    END;
+
+    CREATE TRIGGER quote_stats_t_views_insert
+    AFTER INSERT ON quote_channels
+    BEGIN
+        INSERT INTO quote_stats (channel, kind, key, quotes)
+        SELECT new.channel, 'views', CAST(new.id AS TEXT), views
+        FROM quote_quotes WHERE id = new.quote_id AND views > 0
+        ON CONFLICT (channel, kind, key)
+        DO UPDATE SET quotes = excluded.quotes;
+    END;
+
+    CREATE TRIGGER quote_stats_t_views_delete
+    AFTER DELETE ON quote_channels
+    BEGIN
+        DELETE FROM quote_stats
+        WHERE channel = old.channel AND kind = 'views'
+              AND key = CAST(old.id AS TEXT);
+    END;
+    """,
+
+    # 7: See db_migration_fts5_rowid()
+    db_migration_fts5_rowid,
+]
+
+
+def db_schema_version(dbc):
+    dbc.execute("SELECT version FROM quote_schema;")
+    return dbc.fetchone()[0]
+
+
+def db_migrate(dbc):
+    version = db_schema_version(dbc)
+    for n, script in enumerate(db_migrations[version:], start=version + 1):
+        if callable(script):
+            script = script(dbc)
+        try:
+            dbc.executescript(f"""
+            BEGIN;
+            {script}
+            UPDATE quote_schema SET version = {n};
+            COMMIT;
+            """)
+        except sqlite3.Error:
+            # executescript() stops at the failing statement and leaves
+            # the transaction open.
+            if dbc.connection.in_transaction:
+                dbc.connection.rollback()
+            raise
+
+
+# FTS5 external content mode
+#
+# By default quote_fts5 keeps its own copy of every quote. In external
+# content mode it reads the text from quote_quotes instead, which
+# removes the second copy from the database. The conversion is done
+# once by the bot owner with: quote-initialize fts5-external
+
+def db_fts5_is_external(dbc):
+    sql = """
+        SELECT sql FROM sqlite_master
+        WHERE type = 'table' AND name = 'quote_fts5';
+    """
+    dbc.execute(sql)
+    ret = dbc.fetchone()
+    return ret is not None and "content" in ret[0]
+
+
+def db_fts5_external(dbc):
+    dbc.executescript("""
+    BEGIN;
+
+    DROP TRIGGER IF EXISTS quote_fts5_t_insert;
+    DROP TRIGGER IF EXISTS quote_fts5_t_update;
+    DROP TRIGGER IF EXISTS quote_fts5_t_delete;
+    DROP TABLE IF EXISTS quote_fts5;
+
+    CREATE VIRTUAL TABLE quote_fts5 USING fts5 (
+           id UNINDEXED, quote, tokenize = porter,
+           content = 'quote_quotes', content_rowid = 'id'
+    );
+
+    CREATE TRIGGER quote_fts5_t_insert
+    AFTER INSERT ON quote_quotes
+    BEGIN
+        INSERT INTO quote_fts5 (rowid, id, quote)
+        VALUES (new.id, new.id, new.quote);
+    END;
+
+    CREATE TRIGGER quote_fts5_t_update
+    AFTER UPDATE OF quote ON quote_quotes
+    BEGIN
+        INSERT INTO quote_fts5 (quote_fts5, rowid, id, quote)
+        VALUES ('delete', old.id, old.id, old.quote);
+        INSERT INTO quote_fts5 (rowid, id, quote)
+        VALUES (new.id, new.id, new.quote);
+    END;
+
+    CREATE TRIGGER quote_fts5_t_delete
+    AFTER DELETE ON quote_quotes
+    BEGIN
+        INSERT INTO quote_fts5 (quote_fts5, rowid, id, quote)
+        VALUES ('delete', old.id, old.id, old.quote);
+    END;
+
+    INSERT INTO quote_fts5 (quote_fts5) VALUES ('rebuild');
+
+    COMMIT;
+
+    VACUUM;
+    """)
+    search_pages_invalidate()
+
+
+def db_fts5_optimize(dbc):
+    dbc.execute("INSERT INTO quote_fts5 (quote_fts5) VALUES ('optimize');")
+
+
+def db_fts5_automerge(dbc, level):
+    sql = "INSERT INTO quote_fts5 (quote_fts5, rank) VALUES ('automerge', ?);"
+    dbc.execute(sql, (level,))
+
+
+# quote-initialize : Bot owner database maintenance.
+#     quote-initialize                  Create the tables and migrate
+#     quote-initialize fts5-external    Switch FTS5 to external content
+#     quote-initialize fts5-optimize    Merge the FTS5 index b-trees
+#     quote-initialize fts5-automerge N Set the FTS5 automerge level
+#     quote-initialize minhash          Rebuild the near duplicate index
 
 def quote_initialize(i, irc, dbc):
     nickname = i.msg.get_nickname()
-    if is_bot_owner(irc, nickname):
+    args = i.msg.get_args()
+
+    if not is_bot_owner(irc, nickname):
+        return
+
+    argv = args.split()
+
+    if not argv:
         db_init(dbc)
-        irc.out.notice(nickname, "quote: database initialized")
+        m = "quote: database initialized"
+    elif argv[0] == "fts5-external":
+        if db_fts5_is_external(dbc):
+            m = "quote: FTS5 already uses external content"
+        else:
+            db_fts5_external(dbc)
+            m = "quote: FTS5 rebuilt with external content"
+    elif argv[0] == "fts5-optimize":
+        db_fts5_optimize(dbc)
+        m = "quote: FTS5 index optimized"
+    elif argv[0] == "fts5-automerge" and len(argv) == 2 \
+            and argv[1].isdecimal() and int(argv[1]) <= 16:
+        db_fts5_automerge(dbc, int(argv[1]))
+        m = f"quote: FTS5 automerge set to {argv[1]}"
+    elif argv[0] == "minhash":
+        db_rebuild_minhash(dbc)
+        m = "quote: near duplicate index rebuilt"
+    else:
+        m = ("quote: Usage: quote-initialize"
+             " [fts5-external | fts5-optimize | fts5-automerge <0-16>"
+             " | minhash]")
+
+    irc.out.notice(nickname, m)
 
 
 # ====================================================================
 # Database functions
 # ====================================================================
 
+# Duplicate detection
+
+def quote_normalize(quote):
+    """Remove formatting, case and repeated whitespace from a quote."""
+    return " ".join(remove_formatting(quote).casefold().split())
+
+
+def quote_hash(quote):
+    """64 bit hash of the normalized quote, stored as quote_quotes.hash"""
+    h = hashlib.blake2b(quote_normalize(quote).encode(), digest_size=8)
+    return int.from_bytes(h.digest(), "big", signed=True)
+
+
+# Each shingle hash is split into `minhash_perms' 32 bit hashes
+minhash_struct = struct.Struct(f">{minhash_perms}I")
+
+
+def quote_shingles(quote):
+    q = quote_normalize(quote)
+    return {q[n:n + shingle_size]
+            for n in range(max(1, len(q) - shingle_size + 1))}
+
+
+def quote_minhash_buckets(shingles):
+    """Return the bucket of each MinHash band of the shingles."""
+    hashes = [minhash_struct.unpack(
+        hashlib.blake2b(s.encode(), digest_size=minhash_struct.size).digest())
+        for s in shingles]
+    signature = list(map(min, zip(*hashes)))
+
+    buckets = []
+    for band in range(0, minhash_perms, minhash_rows):
+        key = struct.pack(f">{minhash_rows + 1}I", band,
+                          *signature[band:band + minhash_rows])
+        h = hashlib.blake2b(key, digest_size=8)
+        buckets.append(int.from_bytes(h.digest(), "big", signed=True))
+    return buckets
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
+
+
+def db_add_minhash(dbc, rows):
+    """Insert the buckets of the (quote_id, quote) rows"""
+    sql = """
+        INSERT OR IGNORE INTO quote_minhash (bucket, quote_id)
+        VALUES (?, ?);
+    """
+    dbc.executemany(sql, (
+        (bucket, quote_id)
+        for quote_id, quote in rows
+        for bucket in quote_minhash_buckets(quote_shingles(quote))))
+
+
+def db_rebuild_minhash(dbc):
+    dbc.execute("DELETE FROM quote_minhash;")
+    db_add_minhash(dbc, dbc.connection.execute(
+        "SELECT id, quote FROM quote_quotes;"))
+
+
+def db_find_near_duplicate(dbc, quote, channel):
+    """Return the channel id of a quote similar to `quote', or None."""
+    shingles = quote_shingles(quote)
+    buckets = quote_minhash_buckets(shingles)
+    sql = f"""
+        SELECT c.id, q.quote
+        FROM quote_minhash AS m
+        CROSS JOIN quote_channels AS c ON c.quote_id = m.quote_id
+        INNER JOIN quote_quotes AS q ON q.id = m.quote_id
+        WHERE m.bucket IN ({", ".join("?" * len(buckets))})
+              AND c.channel = ?
+        GROUP BY m.quote_id
+        ORDER BY COUNT(*) DESC
+        LIMIT 3;
+    """
+    dbc.execute(sql, (*buckets, channel))
+    for cqid, candidate in dbc.fetchall():
+        if jaccard(shingles, quote_shingles(candidate)) >= near_dup_threshold:
+            return cqid
+    return None
+
+
 # Insertion functions
 
 def db_is_quote_in_channel(dbc, quote, channel):
     sql = """
         SELECT c.id
-        FROM quote_channels AS c
-        INNER JOIN quote_quotes AS q ON q.id = c.quote_id
-        WHERE c.channel = ? AND q.quote = ?
+        FROM quote_quotes AS q
+        INNER JOIN quote_channels AS c ON c.quote_id = q.id
+        WHERE q.hash = ? AND c.channel = ?
     """
-    dbc.execute(sql, (channel, quote))
+    dbc.execute(sql, (quote_hash(quote), channel))
     ret = dbc.fetchone()
     if ret is None:
         return None  # The quote is not in the channel
@@ -176,24 +752,67 @@ def db_is_quote_in_channel(dbc, quote, channel):
 
 def db_add_quote(dbc, quote, quotee, added_by, channel):
     sql = """
-        INSERT INTO quote_quotes (quote, quotee, added_by)
-        VALUES (?, ?, ?);
+        INSERT INTO quote_quotes (quote, quotee, added_by, hash, added_at)
+        VALUES (?, ?, ?, ?, strftime('%s', 'now'));
     """
-    dbc.execute(sql, (quote, quotee, added_by))
+    dbc.execute(sql, (quote, quotee, added_by, quote_hash(quote)))
 
     quote_id = dbc.lastrowid
-    mcq_id = db_max_channel_quote_id(dbc, channel)
-    mcq_id += 1
+    if near_dup_check:
+        db_add_minhash(dbc, [(quote_id, quote)])
+
+    mcq_id = db_next_channel_quote_id(dbc, channel)
 
     sql = """
         INSERT INTO quote_channels (id, channel, quote_id)
         VALUES (?, ?, ?);
     """
     dbc.execute(sql, (mcq_id, channel, quote_id))
+    search_pages_invalidate()
 
     return mcq_id
 
 
+# RETURNING is only available since SQLite 3.35.0. With older versions
+# the counter is read back with a second statement under `seq_lock'.
+seq_returning = sqlite3.sqlite_version_info >= (3, 35, 0)
+seq_lock = threading.Lock()
+
+
+def db_next_channel_quote_id(dbc, channel):
+    """Allocate the next channel quote id from quote_channel_seq."""
+    sql = """
+        INSERT INTO quote_channel_seq (channel, id) VALUES (?, 1)
+        ON CONFLICT (channel) DO UPDATE SET id = id + 1
+    """
+    if seq_returning:
+        dbc.execute(sql + " RETURNING id;", (channel,))
+        return dbc.fetchone()[0]
+
+    with seq_lock:
+        dbc.execute(sql + ";", (channel,))
+        return db_channel_seq(dbc, channel)
+
+
+def db_channel_seq(dbc, channel):
+    sql = """
+        SELECT id FROM quote_channel_seq WHERE channel = ?;
+    """
+    dbc.execute(sql, (channel,))
+    ret = dbc.fetchone()
+    if ret is None:
+        return 0
+    return ret[0]
+
+
+def db_set_channel_seq(dbc, seqs):
+    sql = """
+        INSERT INTO quote_channel_seq (channel, id) VALUES (?, ?)
+        ON CONFLICT (channel) DO UPDATE SET id = excluded.id;
+    """
+    dbc.executemany(sql, seqs)
+
+
 def db_max_channel_quote_id(dbc, channel):
     sql = """
         SELECT MAX(id) FROM quote_channels WHERE channel = ?;
@@ -207,15 +826,58 @@ def db_max_channel_quote_id(dbc, channel):
 
 
 # Views
+#
+# Viewing a quote must not cost a database write. The views are
+# accumulated in `views_pending' and written with a single executemany()
+# every `views_flush_count' views or `views_flush_interval' seconds, and
+# when the bot exits.
+
+views_pending = {}  # quote_quotes.id -> views not yet written
+views_count = 0
+views_last_flush = time.monotonic()
+views_lock = threading.Lock()
+views_db = None  # Connection used for flushing the views at exit
+
+
+def db_increment_views(_dbc, quote_id):
+    global views_count
+    with views_lock:
+        views_pending[quote_id] = views_pending.get(quote_id, 0) + 1
+        views_count += 1
+
+
+def views_flush_due():
+    with views_lock:
+        return (views_count >= views_flush_count
+                or (views_pending and time.monotonic() - views_last_flush
+                    >= views_flush_interval))
+
+
+def db_flush_views(dbc):
+    global views_pending, views_count, views_last_flush
+    with views_lock:
+        pending = views_pending
+        views_pending = {}
+        views_count = 0
+        views_last_flush = time.monotonic()
+
+    if not pending:
+        return
 
-def db_increment_views(dbc, quote_id):
     sql = """
-        UPDATE quote_quotes
-        SET views = (SELECT views FROM quote_quotes
-                     WHERE id = ?) + 1
-        WHERE id = ?
+        UPDATE quote_quotes SET views = views + ? WHERE id = ?;
     """
-    dbc.execute(sql, (quote_id, quote_id))
+    dbc.executemany(sql, [(n, quote_id) for quote_id, n in pending.items()])
+
+
+def views_atexit():
+    if views_db is None:
+        return
+    db_flush_views(views_db.cursor())
+    views_db.commit()
+
+
+atexit.register(views_atexit)
 
 
 # Deletion functions
@@ -225,6 +887,7 @@ def db_delete_channel_quote(dbc, channel, qcid):
         DELETE FROM quote_channels WHERE id = ? AND channel = ?;
     """
     dbc.execute(sql, (qcid, channel))
+    search_pages_invalidate()
     return True
 
 
@@ -237,21 +900,32 @@ def db_get_quotes_for_quotee(dbc, quotee):
         INNER JOIN quote_quotes AS q ON q.id = c.quote_id
         WHERE q.quotee = ?
     """
+    # The rows are yielded as they are read
     dbc.execute(sql, (quotee,))
-    return dbc.fetchall()
+    yield from dbc
 
 
 def db_get_random_channel_quote_for_quotee(dbc, quotee, channel):
+    # The number of quotes of the quotee is kept in quote_stats. Skip a
+    # random number of them in the index instead of sorting the joined
+    # rows with RANDOM() or reading all of them.
+    n = db_stats_count(dbc, channel, "quotee", quotee)
+    if not n:
+        return None
+
     sql = """
-        SELECT c.id, q.quote, q.quotee, q.added_by, q.views, q.id
+        SELECT c.id
         FROM quote_channels AS c
         INNER JOIN quote_quotes AS q ON q.id = c.quote_id
         WHERE q.quotee = ? AND c.channel = ?
-        ORDER BY RANDOM()
-        LIMIT 1
+        LIMIT 1 OFFSET ?;
     """
-    dbc.execute(sql, (quotee, channel))
-    return dbc.fetchone()
+    dbc.execute(sql, (quotee, channel, random.randrange(n)))
+    ret = dbc.fetchone()
+    if ret is None:
+        return None
+
+    return db_find_by_channel_id(dbc, ret[0], channel)
 
 
 def db_get_quotes_for_added_by(dbc, added_by):
@@ -261,8 +935,9 @@ def db_get_quotes_for_added_by(dbc, added_by):
         INNER JOIN quote_quotes AS q ON q.id = c.quote_id
         WHERE q.added_by = ?
     """
+    # The rows are yielded as they are read
     dbc.execute(sql, (added_by,))
-    return dbc.fetchall()
+    yield from dbc
 
 
 def db_get_channel_quotes_for_added_by(dbc, added_by, channel, limit=1):
@@ -278,15 +953,27 @@ def db_get_channel_quotes_for_added_by(dbc, added_by, channel, limit=1):
 
 
 def db_get_random_quote_from_channel(dbc, channel):
+    # Probe random channel quote ids with the primary key instead of
+    # sorting every quote of the channel with RANDOM().
+    max_id = db_max_channel_quote_id(dbc, channel)
+    if not max_id:
+        return None
+
+    for _ in range(random_quote_probes):
+        q = db_find_by_channel_id(dbc, random.randint(1, max_id), channel)
+        if q:
+            return q
+
+    # Too many gaps, take the first quote after a random id.
     sql = """
         SELECT c.id, q.quote, q.quotee, q.added_by, q.views, q.id
         FROM quote_channels AS c
         INNER JOIN quote_quotes AS q ON q.id = c.quote_id
-        WHERE c.channel = ?
-        ORDER BY RANDOM()
+        WHERE c.channel = ? AND c.id >= ?
+        ORDER BY c.id
         LIMIT 1;
     """
-    dbc.execute(sql, (channel,))
+    dbc.execute(sql, (channel, random.randint(1, max_id)))
     return dbc.fetchone()
 
 
@@ -320,20 +1007,52 @@ def db_find_random_fts5(dbc, query, channel):
     return dbc.fetchone()
 
 
-def db_find_channel_fts5(dbc, query, channel, limit=10):
+def db_find_channel_fts5(dbc, query, channel, limit=10, after=None):
+    # Results are ranked with bm25 and paginated with the (rank, q.id)
+    # key of the last row of the previous page, given in `after'.
+    # q = c.id, q.quote, q.quotee, q.added_by, q.views, q.id,
+    #     f.rank, snippet
     sql = """
-        SELECT c.id, q.quote, q.quotee, q.added_by, q.views, q.id
-        FROM quote_quotes AS q
+        SELECT c.id, q.quote, q.quotee, q.added_by, q.views, q.id,
+               f.rank, snippet(quote_fts5, 1, ?, ?, ?, ?)
+        FROM quote_fts5 AS f
+        INNER JOIN quote_quotes AS q ON q.id = f.id
+        INNER JOIN quote_channels AS c ON q.id = c.quote_id
+        WHERE c.channel = ? AND f.quote MATCH ?
+              AND (f.rank > ? OR (f.rank = ? AND q.id > ?))
+        ORDER BY f.rank, q.id
+        LIMIT ?;
+    """
+    # Make the query an FTS5 string
+    q = query.replace('"', '')
+    q = f'"{q}"'
+
+    rank, qid = after if after else (float("-inf"), 0)
+
+    dbc.execute(sql, ("\x02", "\x0F", "...", snippet_tokens,
+                      channel, q, rank, rank, qid, limit))
+    return dbc.fetchall()
+
+
+def db_find_channel_fts5_keys(dbc, query, channel, limit=10, after=None):
+    # Like db_find_channel_fts5() but only return the (rank, q.id) keys
+    sql = """
+        SELECT f.rank, q.id
+        FROM quote_fts5 AS f
+        INNER JOIN quote_quotes AS q ON q.id = f.id
         INNER JOIN quote_channels AS c ON q.id = c.quote_id
-        INNER JOIN quote_fts5 AS f ON f.id = q.id
         WHERE c.channel = ? AND f.quote MATCH ?
+              AND (f.rank > ? OR (f.rank = ? AND q.id > ?))
+        ORDER BY f.rank, q.id
         LIMIT ?;
     """
     # Make the query an FTS5 string
     q = query.replace('"', '')
     q = f'"{q}"'
 
-    dbc.execute(sql, (channel, q, limit))
+    rank, qid = after if after else (float("-inf"), 0)
+
+    dbc.execute(sql, (channel, q, rank, rank, qid, limit))
     return dbc.fetchall()
 
 
@@ -344,13 +1063,62 @@ def db_find_fts5(dbc, query, limit=10):
         INNER JOIN quote_channels AS c ON q.id = c.quote_id
         INNER JOIN quote_fts5 AS f ON f.id = q.id
         WHERE f.quote MATCH ?
+        ORDER BY f.rank
         LIMIT ?;
     """
     # Make the query an FTS5 string
     q = query.replace('"', '')
     q = f'"{q}"'
 
+    # The rows are yielded as they are read
     dbc.execute(sql, (q, limit))
+    yield from dbc
+
+
+# Statistics functions
+
+def db_stats_top(dbc, channel, kind, limit=5):
+    sql = """
+        SELECT key, quotes FROM quote_stats
+        WHERE channel = ? AND kind = ? AND quotes > 0
+        ORDER BY quotes DESC
+        LIMIT ?;
+    """
+    dbc.execute(sql, (channel, kind, limit))
+    return dbc.fetchall()
+
+
+def db_stats_recent_months(dbc, channel, limit=6):
+    sql = """
+        SELECT key, quotes FROM quote_stats
+        WHERE channel = ? AND kind = 'month' AND quotes > 0
+        ORDER BY key DESC
+        LIMIT ?;
+    """
+    dbc.execute(sql, (channel, limit))
+    return dbc.fetchall()
+
+
+def db_stats_count(dbc, channel, kind, key=""):
+    sql = """
+        SELECT quotes FROM quote_stats
+        WHERE channel = ? AND kind = ? AND key = ?;
+    """
+    dbc.execute(sql, (channel, kind, key))
+    ret = dbc.fetchone()
+    if ret is None:
+        return 0
+    return ret[0]
+
+
+def db_most_viewed(dbc, channel, limit=3):
+    sql = """
+        SELECT CAST(key AS INTEGER), quotes FROM quote_stats
+        WHERE channel = ? AND kind = 'views'
+        ORDER BY quotes DESC
+        LIMIT ?;
+    """
+    dbc.execute(sql, (channel, limit))
     return dbc.fetchall()
 
 
@@ -367,15 +1135,203 @@ def db_match_random(dbc, query, channel):
     return dbc.fetchone()
 
 
+# ====================================================================
+# Bulk import / export
+# ====================================================================
+
+# Quotes are exchanged as JSON lines or as CSV with a header, chosen by
+# the file extension. Every record has the fields of `export_fields'.
+# On import "id" is ignored, new channel ids are assigned, and "views"
+# and "added_at" (a unix timestamp) are optional.
+
+def read_quotes(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+            return
+
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def write_quotes(path, quotes):
+    n = 0
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            writer = csv.DictWriter(f, fieldnames=export_fields)
+            writer.writeheader()
+        for q in quotes:
+            if path.endswith(".csv"):
+                writer.writerow(q)
+            else:
+                f.write(json.dumps(q, ensure_ascii=False) + "\n")
+            n += 1
+    return n
+
+
+# The channel columns are NOCASE, which only folds the ASCII letters
+nocase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def db_import_quotes(dbc, quotes):
+    """Insert the `quotes' iterable in a single transaction.
+
+    The FTS5 and statistics triggers are dropped during the import. The
+    new quotes are indexed and the statistics are recomputed at once at
+    the end. Returns the number of quotes added.
+    """
+    db = dbc.connection
+    if not db.in_transaction:
+        dbc.execute("BEGIN;")
+
+    try:
+        n = _db_import_quotes(dbc, quotes)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        search_pages_invalidate()
+
+    return n
+
+
+def _db_import_quotes(dbc, quotes):
+    sql = """
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'trigger'
+              AND (name LIKE 'quote_fts5_t_%' OR name LIKE 'quote_stats_t_%');
+    """
+    dbc.execute(sql)
+    triggers = dbc.fetchall()
+    for name, _ in triggers:
+        dbc.execute(f"DROP TRIGGER {name};")
+
+    # Assign the quote ids here to avoid reading lastrowid per quote.
+    sql = """
+        SELECT MAX(COALESCE((SELECT MAX(id) FROM quote_quotes), 0),
+                   COALESCE((SELECT seq FROM sqlite_sequence
+                             WHERE name = 'quote_quotes'), 0));
+    """
+    dbc.execute(sql)
+    first_id = dbc.fetchone()[0] + 1
+
+    quote_id = first_id
+    channel_ids = {}  # channel -> [channel, last channel quote id]
+    quotes = iter(quotes)
+    while True:
+        batch = list(islice(quotes, import_batch_size))
+        if not batch:
+            break
+
+        q_rows = []
+        c_rows = []
+        for q in batch:
+            channel = q["channel"]
+            key = channel.translate(nocase)
+            if key not in channel_ids:
+                channel_ids[key] = [channel, db_channel_seq(dbc, channel)]
+            channel_ids[key][1] += 1
+
+            added_at = q.get("added_at")
+            q_rows.append((quote_id, q["quote"], q["quotee"],
+                           q["added_by"], int(q.get("views") or 0),
+                           quote_hash(q["quote"]),
+                           int(added_at) if added_at else None))
+            c_rows.append((channel_ids[key][1], channel, quote_id))
+            quote_id += 1
+
+        sql = """
+            INSERT INTO quote_quotes
+                   (id, quote, quotee, added_by, views, hash, added_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+        """
+        dbc.executemany(sql, q_rows)
+        if near_dup_check:
+            db_add_minhash(dbc, ((r[0], r[1]) for r in q_rows))
+        sql = """
+            INSERT INTO quote_channels (id, channel, quote_id)
+            VALUES (?, ?, ?);
+        """
+        dbc.executemany(sql, c_rows)
+
+    db_set_channel_seq(dbc, channel_ids.values())
+
+    if db_fts5_is_external(dbc):
+        dbc.execute("INSERT INTO quote_fts5 (quote_fts5) VALUES ('rebuild');")
+    else:
+        sql = """
+            INSERT INTO quote_fts5 (rowid, id, quote)
+            SELECT id, id, quote FROM quote_quotes WHERE id >= ?;
+        """
+        dbc.execute(sql, (first_id,))
+
+    for sql in (db_stats_rebuild_sql + db_stats_views_sql).split(";"):
+        dbc.execute(sql)
+
+    for _, sql in triggers:
+        dbc.execute(sql)
+
+    return quote_id - first_id
+
+
+def db_export_quotes(dbc, channel=None):
+    sql = """
+        SELECT c.id, c.channel, q.quote, q.quotee, q.added_by, q.views,
+               q.added_at
+        FROM quote_channels AS c
+        INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+    """
+    if channel is None:
+        dbc.execute(sql + " ORDER BY c.channel, c.id;")
+    else:
+        dbc.execute(sql + " WHERE c.channel = ? ORDER BY c.id;", (channel,))
+
+    for row in dbc:
+        yield dict(zip(export_fields, row))
+
+
 # ====================================================================
 # Web sharing APIs
 # ====================================================================
 
-def pomf_plaintext_upload(data):
+upload_timeout = (10, 120)  # (connect, read) seconds
+upload_retries = 3
+
+
+def pomf_plaintext_upload(chunks):
+    """Upload the text produced by the `chunks' factory to pomf.
+
+    `chunks' is called on every attempt and must return a new iterator
+    of strings. They are streamed as the multipart body, so the whole
+    text never needs to be in memory.
+    """
     url = "https://pomf.lain.la/upload.php"
-    files = {"files[]": ("quotes.txt", data, "text/plain")}
-    r = requests.post(url, files=files)
-    return r.json()["files"][0]["url"]
+    boundary = uuid.uuid4().hex
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+    for attempt in range(1, upload_retries + 1):
+        body = multipart_body(boundary, "files[]", "quotes.txt", chunks())
+        try:
+            r = requests.post(url, data=body, headers=headers,
+                              timeout=upload_timeout)
+            r.raise_for_status()
+            return r.json()["files"][0]["url"]
+        except (requests.RequestException, ValueError, KeyError,
+                IndexError):
+            if attempt == upload_retries:
+                raise
+            time.sleep(5 * attempt)
+
+
+def multipart_body(boundary, name, filename, chunks):
+    yield (f"--{boundary}\r\n"
+           f"Content-Disposition: form-data; name=\"{name}\";"
+           f" filename=\"{filename}\"\r\n"
+           f"Content-Type: text/plain\r\n\r\n").encode()
+    for chunk in chunks:
+        yield chunk.encode("utf-8")
+    yield f"\r\n--{boundary}--\r\n".encode()
 
 
 # ====================================================================
@@ -439,7 +1395,7 @@ def quote_handler(dbc, query, channel):
         return quote_hdl_no_query(dbc, channel)
 
     if len(query.split()) > 1:  # Can't be a nick or an id, do a fts
-        return quote_search_handler(dbc, query, channel)
+        return quote_hdl_fts5(dbc, query, channel)
 
     # Assume query is a channel quote id
 
@@ -460,6 +1416,17 @@ def quote_handler(dbc, query, channel):
     return f"{logo}: No results"
 
 
+def quote_hdl_fts5(dbc, query, channel):
+    # q = c.id, q.quote, q.quotee, q.added_by, q.views, q.id
+    q = db_find_random_fts5(dbc, query, channel)
+    if not q:
+        return f"{logo}: No results"
+
+    db_increment_views(dbc, q[5])
+
+    return format_quote(q)
+
+
 def quote_hdl_no_query(dbc, channel):
     # q = c.id, q.quote, q.quotee, q.added_by, q.views, q.id
     q = db_get_random_quote_from_channel(dbc, channel)
@@ -473,6 +1440,7 @@ def quote_hdl_no_query(dbc, channel):
 
 # quote-search : Search for a quote using FTS5 with the porter tokenizer.
 #     This allows for finding quotes even if the query is not precise.
+#     The results are ranked and split in pages: quote-search <text> --page N
 
 def quote_search(i, irc, dbc):
     if i.msg.is_pm():
@@ -492,8 +1460,8 @@ def quote_search_channel(i, irc, dbc):
         irc.out.notice(msgtarget, m)
         return
 
-    m = quote_search_handler(dbc, args, msgtarget)
-    irc.out.notice(msgtarget, m)
+    for m in quote_search_handler(dbc, args, msgtarget, msgtarget):
+        irc.out.notice(msgtarget, m)
 
 
 def quote_search_pm(i, irc, dbc):
@@ -522,19 +1490,75 @@ def quote_search_pm(i, irc, dbc):
         irc.out.notice(msgtarget, m)
         return
 
-    m = quote_search_handler(dbc, query, channel)
-    irc.out.notice(msgtarget, m)
+    for m in quote_search_handler(dbc, query, channel, msgtarget):
+        irc.out.notice(msgtarget, m)
 
 
-def quote_search_handler(dbc, query, channel):
-    # q = c.id, q.quote, q.quotee, q.added_by, q.views, q.id
-    q = db_find_random_fts5(dbc, query, channel)
-    if not q:
-        return f"{logo}: No results"
+def quote_search_handler(dbc, query, channel, msgtarget):
+    query, page = search_parse_page(query)
+
+    # pages[n] is the key of the last row before page n + 1. The keys of
+    # the pages that have not been seen yet are fetched in a single
+    # query continuing from the last known key, so a deep page costs
+    # about as much as the first one.
+    # The keys hold bm25 ranks, which change with every quote added or
+    # deleted, so the pages are only reused for the same `search_version'.
+    key = (msgtarget, channel, query.lower())
+    version = search_version
+    cached = search_pages.pop(key, None)
+    pages = cached[1] if cached and cached[0] == version else [None]
+    missing = page - len(pages)
+    if missing > 0:
+        r = db_find_channel_fts5_keys(dbc, query, channel,
+                                      limit=missing * search_page_size,
+                                      after=pages[-1])
+        pages += r[search_page_size - 1::search_page_size]
+
+    if len(pages) < page:
+        return [f"{logo}: No results"]
+
+    # Fetch one more row to tell if there is a next page
+    # q = c.id, q.quote, q.quotee, q.added_by, q.views, q.id,
+    #     f.rank, snippet
+    r = db_find_channel_fts5(dbc, query, channel,
+                             limit=search_page_size + 1,
+                             after=pages[page - 1])
+    if not r:
+        return [f"{logo}: No results"]
+
+    acc = []
+    for q in r[:search_page_size]:
+        db_increment_views(dbc, q[5])
+        acc.append(format_quote((q[0], q[7], q[2], q[3])))
 
-    db_increment_views(dbc, q[5])
+    if len(r) > search_page_size:
+        acc.append(f"{logo}: Page {page}. For more use: --page {page + 1}")
+        if len(pages) == page:
+            pages.append((r[-2][6], r[-2][5]))
 
-    return format_quote(q)
+    search_pages[key] = (version, pages)
+    if len(search_pages) > search_pages_max:
+        del search_pages[next(iter(search_pages))]
+
+    return acc
+
+
+def search_pages_invalidate():
+    """Forget the cached search pages. Called when the quotes or the
+    FTS5 index change.
+    """
+    global search_version
+    search_version += 1
+    search_pages.clear()
+
+
+def search_parse_page(query):
+    """Split the ``--page N'' option from the end of the query."""
+    argv = query.rsplit(None, 2)
+    if len(argv) == 3 and argv[1] == "--page" and argv[2].isdecimal() \
+            and int(argv[2]) > 0:
+        return argv[0], int(argv[2])
+    return query, 1
 
 
 # quote-match : Search for a quote using an exact string
@@ -602,6 +1626,63 @@ def quote_match_handler(dbc, query, channel):
     return format_quote(q)
 
 
+# quote-stats : Quote statistics of a channel or a user
+
+def quote_stats(i, irc, dbc):
+    msgtarget = i.msg.get_msgtarget()
+    botcmd = i.msg.get_botcmd()
+    prefix = i.msg.get_botcmd_prefix()
+    args = i.msg.get_args()
+
+    argv = args.split()
+
+    channel = None if i.msg.is_pm() else msgtarget
+    if argv and argv[0][:1] in irc.chantypes:
+        channel = argv.pop(0)
+
+    if channel is None or len(argv) > 1:
+        m = f"{logo}: Usage: {prefix}{botcmd} [#channel] [nickname]"
+        irc.out.notice(msgtarget, m)
+        return
+
+    if channel not in irc.channels:
+        m = f"{logo}: The bot has not joined the channel: {channel}"
+        irc.out.notice(msgtarget, m)
+        return
+
+    if argv:
+        m = quote_stats_nickname(dbc, channel, argv[0])
+    else:
+        m = quote_stats_channel(dbc, channel)
+    irc.out.notice(msgtarget, m)
+
+
+def quote_stats_channel(dbc, channel):
+    total = db_stats_count(dbc, channel, "total")
+    if not total:
+        return f"{logo}: No quotes in {channel}"
+
+    db_flush_views(dbc)  # Include the views that are not yet written
+
+    def fmt(rows, pfx=""):
+        return ", ".join(f"{pfx}{k} ({n})" for k, n in rows) or "-"
+
+    return (
+        f"{logo} {channel}: {total} quotes"
+        f" | Most quoted: {fmt(db_stats_top(dbc, channel, 'quotee'))}"
+        f" | Top adders: {fmt(db_stats_top(dbc, channel, 'added_by'))}"
+        f" | Most viewed: {fmt(db_most_viewed(dbc, channel), '#')}"
+        f" | Per month: {fmt(db_stats_recent_months(dbc, channel))}"
+    )
+
+
+def quote_stats_nickname(dbc, channel, nickname):
+    quoted = db_stats_count(dbc, channel, "quotee", nickname)
+    added = db_stats_count(dbc, channel, "added_by", nickname)
+    return (f"{logo} {channel}: {nickname} has been quoted {quoted} times"
+            f" and has added {added} quotes.")
+
+
 # quote-add : Insert channel quotes
 
 def quote_add(i, irc, dbc):
@@ -633,8 +1714,14 @@ def quote_add(i, irc, dbc):
         irc.out.notice(msgtarget, m)
         return
 
+    similar = None
+    if near_dup_check:
+        similar = db_find_near_duplicate(dbc, quote, msgtarget)
+
     qcid = db_add_quote(dbc, quote, quotee, nickname, msgtarget)
     m = f"{logo}: #{qcid} Added!"
+    if similar:
+        m += f" It looks similar to #{similar}."
     irc.out.notice(msgtarget, m)
 
 
@@ -685,40 +1772,119 @@ def quote_del(i, irc, dbc):
 def quote_list_mentioned(i, irc, dbc):
     nickname = i.msg.get_nickname()
 
-    acc = "Channel ID | Channel | Quote | Quotee | Added by | Views | ID\n\n"
+    db_flush_views(dbc)  # Include the views that are not yet written
 
-    acc += "-- Quotes in which you are the quotee: \n\n"
+    # The listing is read and uploaded by a worker thread, so that the
+    # bot does not wait for the upload.
+    thread = threading.Thread(target=list_mentioned_worker,
+                              args=(irc, dbc.connection, nickname),
+                              daemon=True)
+    thread.start()
 
-    # q[0] = c.id, c.channel, q.quote, q.quotee, q.added_by, q.views, q.id
-    q = db_get_quotes_for_quotee(dbc, nickname)
-    if q is not None:
-        for i in q:
-            acc += (f"{i[0]} | {i[1]} | {i[2]} | {i[3]} | {i[4]} | {i[5]}"
-                    f" | {i[6]}\n")
-
-    acc += "\n\n-- Quotes that you added: \n\n"
-
-    # q[0] = c.id, c.channel, q.quote, q.quotee, q.added_by, q.views, q.id
-    q = db_get_quotes_for_added_by(dbc, nickname)
-    if q is not None:
-        for i in q:
-            acc += (f"{i[0]} | {i[1]} | {i[2]} | {i[3]} | {i[4]} | {i[5]}"
-                    f" | {i[6]}\n")
+    m = f"{logo}: Collecting your quotes. I will send you the link shortly."
+    irc.out.notice(nickname, m)  # Send as PM for privacy reasons.
 
-    acc += "\n\n-- Quotes that include your nickname: \n\n"
 
-    # q[0] = c.id, c.channel, q.quote, q.quotee, q.added_by, q.views, q.id
-    q = db_find_fts5(dbc, nickname, limit=-1)
-    if q is not None:
-        for i in q:
-            acc += (f"{i[0]} | {i[1]} | {i[2]} | {i[3]} | {i[4]} | {i[5]}"
-                    f" | {i[6]}\n")
+def list_mentioned_worker(irc, db, nickname):
+    try:
+        pomf_url = pomf_plaintext_upload(
+            lambda: list_mentioned(db.cursor(), nickname))
+    except Exception:
+        m = f"{logo}: Your quotes could not be uploaded. Try again later."
+        irc.out.notice(nickname, m)
+        return
 
-    pomf_url = pomf_plaintext_upload(acc)
     m = f"{logo}: Your quotes can be found here: {pomf_url}"
     irc.out.notice(nickname, m)  # Send as PM for privacy reasons.
 
 
+def list_mentioned(dbc, nickname):
+    yield "Channel ID | Channel | Quote | Quotee | Added by | Views | ID\n\n"
+
+    yield "-- Quotes in which you are the quotee: \n\n"
+
+    # q = c.id, c.channel, q.quote, q.quotee, q.added_by, q.views, q.id
+    for q in db_get_quotes_for_quotee(dbc, nickname):
+        yield list_mentioned_row(q)
+
+    yield "\n\n-- Quotes that you added: \n\n"
+
+    # q = c.id, c.channel, q.quote, q.quotee, q.added_by, q.views, q.id
+    for q in db_get_quotes_for_added_by(dbc, nickname):
+        yield list_mentioned_row(q)
+
+    yield "\n\n-- Quotes that include your nickname: \n\n"
+
+    # q = c.id, c.channel, q.quote, q.quotee, q.added_by, q.views, q.id
+    for q in db_find_fts5(dbc, nickname, limit=-1):
+        yield list_mentioned_row(q)
+
+
+def list_mentioned_row(q):
+    return f"{q[0]} | {q[1]} | {q[2]} | {q[3]} | {q[4]} | {q[5]} | {q[6]}\n"
+
+
+# quote-import / quote-export : Bot owner bulk operations on files
+#     stored in the bot's host.
+
+def quote_import(i, irc, dbc):
+    nickname = i.msg.get_nickname()
+    botcmd = i.msg.get_botcmd()
+    prefix = i.msg.get_botcmd_prefix()
+    args = i.msg.get_args()
+
+    if not is_bot_owner(irc, nickname):
+        return
+
+    if not args:
+        m = f"{logo}: Usage: {prefix}{botcmd} <file.jsonl|file.csv>"
+        irc.out.notice(nickname, m)
+        return
+
+    # Other modules commit the shared connection at any time, which
+    # would save a partial import without its triggers. Import on a
+    # connection of its own, like the command line does.
+    try:
+        db = connect(dbc.connection)
+        try:
+            n = db_import_quotes(db.cursor(), read_quotes(args))
+            db.commit()
+        finally:
+            db.close()
+    except (OSError, ValueError, KeyError, TypeError, csv.Error,
+            sqlite3.Error) as e:
+        irc.out.notice(nickname, f"{logo}: Import failed: {e!r}")
+        return
+
+    irc.out.notice(nickname, f"{logo}: {n} quotes imported.")
+
+
+def quote_export(i, irc, dbc):
+    nickname = i.msg.get_nickname()
+    botcmd = i.msg.get_botcmd()
+    prefix = i.msg.get_botcmd_prefix()
+    args = i.msg.get_args()
+
+    if not is_bot_owner(irc, nickname):
+        return
+
+    argv = args.split()
+    if not argv or len(argv) > 2:
+        m = f"{logo}: Usage: {prefix}{botcmd} <file.jsonl|file.csv> [#channel]"
+        irc.out.notice(nickname, m)
+        return
+
+    channel = argv[1] if len(argv) == 2 else None
+
+    try:
+        n = write_quotes(argv[0], db_export_quotes(dbc, channel))
+    except OSError as e:
+        irc.out.notice(nickname, f"{logo}: Export failed: {e!r}")
+        return
+
+    irc.out.notice(nickname, f"{logo}: {n} quotes exported.")
+
+
 # ====================================================================
 # Main
 # ====================================================================
@@ -726,8 +1892,11 @@ def quote_list_mentioned(i, irc, dbc):
 dispatch = {
     "__STARTUP": lambda _i, _irc, dbc: db_init(dbc),
     "quote-initialize": quote_initialize,
+    "quote-import": quote_import,
+    "quote-export": quote_export,
     "quote": quote,
     "quote-search": quote_search,
+    "quote-stats": quote_stats,
     "quote-match": quote_match,
     "quote-del": quote_del,
     "quote-list-mentioned": quote_list_mentioned,
@@ -742,6 +1911,8 @@ dispatch = {
 
 
 def main(i, irc):
+    global views_db
+
     try:
         botcmd = i.msg.get_botcmd()
     except AttributeError:
@@ -749,7 +1920,47 @@ def main(i, irc):
 
     db = i.db_disk
     dbc = db.cursor()
+    views_db = db
 
     dispatch[botcmd](i, irc, dbc)
 
+    if views_flush_due():
+        db_flush_views(dbc)
+
     db.commit()  # Save any changes
+
+
+# ====================================================================
+# Command line interface
+# ====================================================================
+
+# Import and export quotes without running the bot. drastikbot's source
+# directory must be in PYTHONPATH:
+#     python3 quote.py import drastikbot.db quotes.jsonl
+#     python3 quote.py export drastikbot.db quotes.csv --channel '#lain'
+
+def cli():
+    parser = argparse.ArgumentParser(
+        description="Import or export the quotes of drastikbot.")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("database", help="the bot's SQLite database")
+    parser.add_argument("file", help="a .jsonl or .csv file")
+    parser.add_argument("--channel", help="only export this channel")
+    args = parser.parse_args()
+
+    db = sqlite3.connect(args.database)
+    dbc = db.cursor()
+    db_init(dbc)
+
+    if args.action == "import":
+        n = db_import_quotes(dbc, read_quotes(args.file))
+    else:
+        n = write_quotes(args.file, db_export_quotes(dbc, args.channel))
+
+    db.commit()
+    db.close()
+    print(f"quote: {n} quotes {args.action}ed")
+
+
+if __name__ == "__main__":
+    cli()
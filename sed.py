@@ -6,11 +6,12 @@
 # Replace text using sed.
 #
 # This module keeps a buffer of the last posted messages
-# and when the substitution command is issued it calls sed
-# and sends the result.
+# and when the substitution command is issued it applies it
+# to the matching message and sends the result.
 #
-# Depends:
-#   - sed :: default unix program, should be in the repos
+# The substitution is done in-process. The POSIX extended
+# regular expression is translated to a python `re' pattern
+# and the replacement is expanded like GNU sed does.
 
 '''
 Copyright (C) 2018, 2021 drastik.org
@@ -29,8 +30,14 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-import subprocess
+import atexit
 import re
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import lru_cache
+from itertools import islice
+
 from dbot_tools import p_truncate
 
 
@@ -44,37 +51,591 @@ class Module:
             " For flags and a detailed explanation see:"
             " https://www.gnu.org/software/sed/manual/html_node/"
             "The-_0022s_0022-Command.html"
+            " | Your own messages are matched first."
             " | Extensions: \"s///-n\" n is the number of matches to skip"
-            " If the 'number' flag is used -n should be used after it.")
+            " If the 'number' flag is used -n should be used after it."
+            " \"s///@nick\" only matches the messages of nick.")
     }
 
 
-def write(varget, varset, channel, msg):
-    msgdict = varget('msgdict', defval={channel: [msg]})
+# ----- Constants ----- #
+history_depth = 50  # Messages kept per channel
+history_max_size = 2 * 1024 * 1024  # Characters kept across all channels
+history_idle = 3600 * 24 * 7  # Seconds before an idle channel is dropped
+max_unbounded = 2  # Max number of *, + and {n,} in a regexp
+# Seconds between the snapshots of the history in the database, used to
+# restore it after a restart. Set to 0 to disable.
+snapshot_interval = 300
+# --------------------- #
+
+
+# ====================================================================
+# Message history
+# ====================================================================
+
+# channel -> (msgs, nicks)
+#   msgs:  deque of the last (nickname, message) of the channel
+#   nicks: lowercase nickname -> deque of the same entries of msgs
+#          that were posted by that nickname
+# Ordered from the least to the most recently active channel.
+history = OrderedDict()
+history_time = {}  # channel -> time of the last message
+history_size = 0  # Characters stored in all the channels
+history_lock = threading.Lock()
+
+
+def write(channel, nickname, msg):
+    now = time.monotonic()
+    with history_lock:
+        history_append(channel, nickname, msg)
+        history_time[channel] = now
+        history_dirty.add(channel)
+        history_evict(now)
+
 
+def history_append(channel, nickname, msg):
+    global history_size
+
+    entry = (nickname, msg)
     try:
-        msgdict[channel].append(msg)
+        msgs, nicks = history[channel]
+        history.move_to_end(channel)
     except KeyError:
-        msgdict.update({channel: [msg]})
+        msgs, nicks = deque(maxlen=history_depth), {}
+        history[channel] = (msgs, nicks)
+
+    if len(msgs) == msgs.maxlen:
+        # The oldest entry of the channel is also the oldest entry of
+        # its nickname.
+        old_nickname, old_msg = msgs[0]
+        history_size -= len(old_msg)
+        key = old_nickname.lower()
+        nicks[key].popleft()
+        if not nicks[key]:
+            del nicks[key]
+
+    msgs.append(entry)
+    nicks.setdefault(nickname.lower(), deque()).append(entry)
+    history_size += len(msg)
+
+
+def history_evict(now):
+    """Drop the least recently active channels while they are idle or
+    while the history is over its size limit.
+    """
+    global history_size
+
+    while len(history) > 1:  # The most recent channel is always kept
+        channel = next(iter(history))
+        if history_size <= history_max_size \
+           and now - history_time[channel] < history_idle:
+            break
+
+        msgs, _ = history[channel]
+        history_size -= sum(len(msg) for _, msg in msgs)
+        del history_time[channel]
+        del history[channel]
+        history_dirty.add(channel)
+
+
+def read(channel, nickname=None):
+    """Return the (nickname, message) entries of the channel, or only
+    the ones of `nickname' if given.
+    """
+    with history_lock:
+        try:
+            msgs, nicks = history[channel]
+        except KeyError:
+            return []
+        if nickname is None:
+            return list(msgs)
+        return list(nicks.get(nickname.lower(), ()))
+
+
+# ====================================================================
+# History snapshots
+# ====================================================================
+
+# The history of the channels that changed is saved in the database
+# every `snapshot_interval' seconds, each snapshot in one transaction.
+# After a restart, the history of a channel is loaded on its first
+# message, so the startup does not depend on the number of channels.
+
+history_dirty = set()  # Channels changed since the last snapshot
+history_loaded = set()  # Channels loaded from the last snapshot
+history_db = None  # Connection used for the snapshot at exit
+snapshot_last = time.monotonic()
+snapshot_table_ready = False
+
+
+def db_init(db):
+    global snapshot_table_ready
+
+    if snapshot_table_ready:
+        return
+
+    dbc = db.cursor()
+    sql = """
+        CREATE TABLE IF NOT EXISTS sed_history (
+               channel  TEXT COLLATE NOCASE NOT NULL,
+               seq      INTEGER NOT NULL,
+               nickname TEXT NOT NULL,
+               msg      TEXT NOT NULL,
+               PRIMARY KEY(channel, seq)
+        ) WITHOUT ROWID;
+    """
+    dbc.execute(sql)
+    db.commit()
+    snapshot_table_ready = True
+
+
+def history_load(db, channel):
+    if channel in history_loaded:
+        return
+
+    db_init(db)
+    dbc = db.cursor()
+    sql = """
+        SELECT nickname, msg FROM sed_history
+        WHERE channel = ? ORDER BY seq;
+    """
+    dbc.execute(sql, (channel,))
+    rows = dbc.fetchall()
+
+    with history_lock:
+        if channel in history_loaded:
+            return
+        history_loaded.add(channel)
+        for nickname, msg in rows:
+            history_append(channel, nickname, msg)
+        if rows:
+            history_time[channel] = time.monotonic()
+
+
+def history_snapshot(db):
+    global snapshot_last
+
+    with history_lock:
+        snapshot_last = time.monotonic()
+        changed = {channel: list(history[channel][0])
+                   if channel in history else []
+                   for channel in history_dirty}
+        history_dirty.clear()
+
+    if not changed:
+        return
+
+    db_init(db)
+    dbc = db.cursor()
+    with db:
+        dbc.executemany("DELETE FROM sed_history WHERE channel = ?;",
+                        [(channel,) for channel in changed])
+        dbc.executemany(
+            "INSERT INTO sed_history VALUES (?, ?, ?, ?);",
+            [(channel, n, nickname, msg)
+             for channel, entries in changed.items()
+             for n, (nickname, msg) in enumerate(entries)])
+
+
+def snapshot_due():
+    return (snapshot_interval
+            and time.monotonic() - snapshot_last >= snapshot_interval)
+
+
+def snapshot_atexit():
+    if snapshot_interval and history_db is not None:
+        history_snapshot(history_db)
+
+
+atexit.register(snapshot_atexit)
+
+
+def history_matches(pattern, channel, nickname, only_nickname=False):
+    """Yield the entries that match, newest first. The messages of
+    `nickname' are tried before the ones of the other users.
+    """
+    for entry in reversed(read(channel, nickname)):
+        if pattern.search(entry[1]):
+            yield entry
+
+    if only_nickname:
+        return
+
+    key = nickname.lower()
+    for entry in reversed(read(channel)):
+        if entry[0].lower() != key and pattern.search(entry[1]):
+            yield entry
+
+
+# ====================================================================
+# POSIX ERE to python regular expressions
+# ====================================================================
 
-    if len(msgdict[channel]) > 50:
-        del msgdict[channel][0]
+posix_classes = {
+    "alpha": "a-zA-Z",
+    "digit": "0-9",
+    "alnum": "0-9A-Za-z",
+    "upper": "A-Z",
+    "lower": "a-z",
+    "space": " \\t\\n\\r\\f\\v",
+    "blank": " \\t",
+    "punct": "!-/:-@\\[-`{-~",
+    "print": " -~",
+    "graph": "!-~",
+    "cntrl": "\\x00-\\x1f\\x7f",
+    "xdigit": "0-9A-Fa-f",
+}
 
-    varset('msgdict', msgdict)
 
+def ere_quantifier(pattern, i):
+    """Return the quantifier at pattern[i], or None, and the minimum and
+    maximum number of repetitions it allows, the maximum None if
+    unbounded.
+    """
+    c = pattern[i]
+    if c == "*":
+        return c, 0, None
+    if c == "+":
+        return c, 1, None
+    if c == "?":
+        return c, 0, 1
+    if c == "{":
+        m = ere_interval.match(pattern, i)
+        if m:
+            low, comma, high = m.groups()
+            low = int(low or 0)
+            if not comma:
+                return m.group(0), low, low
+            return m.group(0), low, int(high) if high else None
+    return None, None, None
 
-def read(varget, channel):
-    return varget('msgdict')[channel]
 
+def ere_collapse(first, second):
+    """Return the quantifier equal to `first' followed by `second', both
+    out of *, + and ?. For example "a+?" is "a*" and "a??" is "a?".
+    """
+    return first if first == second and first in "+?" else "*"
 
-def call_sed(msg, sed_args):
-    echo = ['echo', msg]
-    p = subprocess.run(echo, stdout=subprocess.PIPE)
-    echo_outs = p.stdout
-    sed = ['sed', '-r', '--sandbox',
-           f's/{sed_args[1]}/{sed_args[2]}/{sed_args[3]}']
-    p = subprocess.run(sed, stdout=subprocess.PIPE, input=echo_outs)
-    return p.stdout.decode('utf-8')
+
+def ere_to_re(pattern):
+    """Translate a POSIX extended regular expression (with the GNU
+    extensions that sed supports) to a python regular expression.
+    """
+    acc = []
+    groups = []  # Index in acc of each open group
+    atom = None  # Index in acc of the last atom, None if there is none
+    quantified = False  # Whether the last atom has a quantifier
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        quantifier, _, _ = ere_quantifier(pattern, i)
+        if quantifier:
+            if atom is None:
+                raise re.error("invalid preceding regular expression")
+            # In ERE a quantifier applies to the quantified atom before
+            # it. Python would read "a+?" as lazy, "a*+" as possessive
+            # and reject "a**".
+            if quantified and len(quantifier) == len(acc[-1]) == 1:
+                acc[-1] = ere_collapse(acc[-1], quantifier)
+                i += 1
+                continue
+            if quantified:
+                acc[atom:] = ["(?:", *acc[atom:], ")"]
+            acc.append(quantifier)
+            quantified = True
+            i += len(quantifier)
+            continue
+
+        quantified = False
+        atom = len(acc)
+        if c == "\\":
+            if i + 1 == len(pattern):
+                raise re.error("trailing backslash")
+            acc.append(ere_escape(pattern[i + 1]))
+            i += 2
+        elif c == "[":
+            i, bracket = ere_bracket(pattern, i)
+            acc.append(bracket)
+        elif c == "(":
+            if pattern[i + 1:i + 2] == "?":
+                raise re.error("invalid preceding regular expression")
+            groups.append(atom)
+            acc.append(c)
+            atom = None
+            i += 1
+        elif c == ")" and groups:
+            atom = groups.pop()
+            acc.append(c)
+            i += 1
+        else:
+            if c in "|^$":
+                atom = None
+            acc.append(c)
+            i += 1
+    return "".join(acc)
+
+
+ere_interval = re.compile(r"\{(\d*)(,(\d*))?\}")
+
+
+def ere_check(pattern):
+    """Reject the regular expressions that can make the matching take
+    exponential or high polynomial time:
+      - a repeated atom that has a variable quantifier inside, like
+        "(a+)+", "(.*a){12}", "a*{12}" or "(a{1,30}){1,30}";
+      - an unboundedly repeated atom with any quantifier inside, like
+        "(a?)+";
+      - a repeated group with an alternation inside, like "(a|aa)*";
+      - many unbounded quantifiers, like ".*.*.*x".
+    """
+    # What each open group contains, out of "quantifier", "variable"
+    # (a quantifier that allows more than one number of repetitions) and
+    # "alternation".
+    groups = [set()]
+    atom = set()  # What the atom a quantifier would apply to contains
+    base = set()  # The same, before its last quantifier
+    last = None  # The last quantifier, if it was the last token
+    unbounded = 0
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        quantifier, least, most = ere_quantifier(pattern, i)
+        if quantifier and last and len(quantifier) == len(last) == 1:
+            # Checked as the single quantifier they are equal to
+            if last != "?":
+                unbounded -= 1
+            quantifier = ere_collapse(last, quantifier)
+            least = 1 if quantifier == "+" else 0
+            most = 1 if quantifier == "?" else None
+            atom = base
+        elif quantifier:
+            base = atom
+        if quantifier:
+            if most is None or most > 1:
+                if "alternation" in atom:
+                    raise re.error("repeated alternations are not allowed")
+                if "variable" in atom or (most is None
+                                          and "quantifier" in atom):
+                    raise re.error("nested quantifiers are not allowed")
+            atom = atom | {"quantifier"}
+            if least != most:
+                atom.add("variable")
+            if most is None:
+                unbounded += 1
+            groups[-1] |= atom
+            last = quantifier
+            i += len(quantifier)
+            continue
+
+        atom = set()
+        last = None
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            i, _ = ere_bracket(pattern, i)
+            continue
+        elif c == "(":
+            groups.append(set())
+        elif c == ")" and len(groups) > 1:
+            atom = groups.pop()
+            groups[-1] |= atom
+        elif c == "|":
+            groups[-1].add("alternation")
+        i += 1
+
+    if unbounded > max_unbounded:
+        raise re.error(f"more than {max_unbounded} unbounded quantifiers"
+                       " are not allowed")
+
+
+def ere_escape(c):
+    if c == "<":
+        return r"\b(?=\w)"
+    if c == ">":
+        return r"\b(?<=\w)"
+    if c == "`":
+        return r"\A"
+    if c == "'":
+        return r"\Z"
+    if c in "123456789wWsSbBnt":
+        return f"\\{c}"
+    return re.escape(c)
+
+
+def ere_bracket(pattern, i):
+    """Translate the bracket expression starting at pattern[i].
+    Return the index after it and the translation.
+    """
+    acc = "["
+    i += 1
+    if pattern[i:i + 1] == "^":
+        acc += "^"
+        i += 1
+    if pattern[i:i + 1] == "]":
+        acc += "\\]"
+        i += 1
+
+    while i < len(pattern) and pattern[i] != "]":
+        if pattern.startswith("[:", i):
+            end = pattern.find(":]", i + 2)
+            name = pattern[i + 2:end]
+            if end == -1 or name not in posix_classes:
+                raise re.error("invalid character class")
+            acc += posix_classes[name]
+            i = end + 2
+        elif pattern.startswith("[=", i) or pattern.startswith("[.", i):
+            end = pattern.find(pattern[i + 1] + "]", i + 2)
+            if end != i + 3:
+                raise re.error("invalid collation character")
+            acc += re.escape(pattern[i + 2])
+            i = end + 2
+        elif pattern.startswith("\\n", i) or pattern.startswith("\\t", i):
+            acc += pattern[i:i + 2]
+            i += 2
+        else:
+            # The backslash is not special in bracket expressions and
+            # python gives a meaning to some character pairs.
+            c = pattern[i]
+            acc += f"\\{c}" if c in "\\[&~|" else c
+            i += 1
+
+    if i == len(pattern):
+        raise re.error("unterminated [")
+    return i + 1, acc + "]"
+
+
+# ====================================================================
+# The s command
+# ====================================================================
+
+def parse_replacement(replacement):
+    """Split the replacement in tokens of:
+    ("lit", text), ("group", n) or ("case", one of "LUluE")
+    """
+    tokens = []
+    i = 0
+    while i < len(replacement):
+        c = replacement[i]
+        if c == "&":
+            tokens.append(("group", 0))
+        elif c == "\\" and i + 1 < len(replacement):
+            i += 1
+            c = replacement[i]
+            if c.isdecimal():
+                tokens.append(("group", int(c)))
+            elif c in "LUluE":
+                tokens.append(("case", c))
+            elif c == "n":
+                tokens.append(("lit", "\n"))
+            elif c == "t":
+                tokens.append(("lit", "\t"))
+            else:
+                tokens.append(("lit", c))
+        else:
+            tokens.append(("lit", c))
+        i += 1
+    return tokens
+
+
+def expand_replacement(tokens, m):
+    acc = []
+    case = None  # \U or \L until \E
+    case_one = None  # \u or \l for the next character
+    for kind, value in tokens:
+        if kind == "case":
+            if value in "UL":
+                case, case_one = value, None
+            elif value == "E":
+                case, case_one = None, None
+            else:
+                case_one = value
+            continue
+
+        text = value if kind == "lit" else (m.group(value) or "")
+        if not text:
+            continue
+        if case == "U":
+            text = text.upper()
+        elif case == "L":
+            text = text.lower()
+        if case_one == "u":
+            text = text[0].upper() + text[1:]
+        elif case_one == "l":
+            text = text[0].lower() + text[1:]
+        case_one = None
+        acc.append(text)
+    return "".join(acc)
+
+
+def parse_flags(flags):
+    """Return the re flags, the first match to replace and whether all
+    the matches after it should be replaced too.
+    """
+    re_flags = 0
+    occurrence = ""
+    is_global = False
+    for c in flags:
+        if c == "g":
+            is_global = True
+        elif c in "iI":
+            re_flags |= re.I
+        elif c in "mM":
+            re_flags |= re.M
+        elif c.isdecimal():
+            occurrence += c
+        else:
+            raise re.error("unknown option to `s'")
+
+    if occurrence and int(occurrence) == 0:
+        raise re.error("number option to `s' command may not be zero")
+    return re_flags, int(occurrence or 1), is_global
+
+
+@lru_cache(maxsize=128)
+def ere_compile(regexp, re_flags):
+    ere_check(regexp)
+    return re.compile(ere_to_re(regexp), re_flags)
+
+
+def sed_compile(regexp, replacement, flags):
+    """Compile the parts of a s/regexp/replacement/flags command."""
+    if not regexp:
+        raise re.error("no previous regular expression")
+
+    re_flags, occurrence, is_global = parse_flags(flags)
+    pattern = ere_compile(regexp, re_flags)
+    tokens = parse_replacement(replacement)
+    for kind, value in tokens:
+        if kind == "group" and value > pattern.groups:
+            raise re.error(f"invalid reference \\{value} on `s' command's RHS")
+    return pattern, tokens, occurrence, is_global
+
+
+def sed_substitute(sed, text):
+    pattern, tokens, occurrence, is_global = sed
+
+    acc = []
+    pos = 0
+    n = 0
+    last_end = -1
+    for m in pattern.finditer(text):
+        # Like sed, do not match an empty string right after a match
+        if m.start() == m.end() == last_end:
+            continue
+        last_end = m.end()
+
+        n += 1
+        if n < occurrence:
+            continue
+
+        acc.append(text[pos:m.start()])
+        acc.append(expand_replacement(tokens, m))
+        pos = m.end()
+        if not is_global:
+            break
+
+    acc.append(text[pos:])
+    return "".join(acc)
 
 
 sed_parse = re.compile('(?<!\\\\)/')
@@ -82,12 +643,20 @@ sed_cmd = re.compile('^s/.*/.*')
 
 
 def main(i, irc):
+    global history_db
+
     nickname = i.msg.get_nickname()
     msgtarget = i.msg.get_msgtarget()
     text = i.msg.get_text()
 
+    if snapshot_interval:
+        history_db = i.db_disk
+        history_load(i.db_disk, msgtarget)
+        if snapshot_due():
+            history_snapshot(i.db_disk)
+
     if not sed_cmd.match(text):
-        write(i.varget, i.varset, msgtarget, text)
+        write(msgtarget, nickname, text)
         return
 
     sed_out = ""
@@ -97,8 +666,6 @@ def main(i, irc):
         # check if the last / is missed etc.
         return
 
-    msglist = read(i.varget, msgtarget)
-
     # Extension to allow the user match previous messages.
     # It uses the special syntax: "s///-n" where n is the
     # number of matches to skip.
@@ -108,11 +675,16 @@ def main(i, irc):
     #            before the - command or two characters after
     #            the - .
     # The following code is for parsing the command. It
-    # edits the "goback" variable which will be used in the
-    # loop below.
+    # edits the "goback" variable which is the number of
+    # matching messages skipped below.
     # We use two decimals because the queue save upto 50
     # messages.
-    goback = False
+    # "s///flags@nick" only matches the messages of nick.
+    target = None
+    if '@' in sed_args[3]:
+        sed_args[3], target = sed_args[3].split('@', 1)
+
+    goback = 0
     if '-' in sed_args[3]:
         s = sed_args[3]
         idx = s.index('-')
@@ -123,49 +695,34 @@ def main(i, irc):
             goback = int(s[idx + 1])
             sed_args[3] = f'{s[:idx]}{s[idx + 2:]}'
 
-    n = 1
-    while n <= 50:
-        flags = 0
-        if 'i' in sed_args[3]:
-            flags |= re.I
-
-        try:
-            db_search = re.search(sed_args[1], msglist[-n], flags)
-        except re.error as e:  # Invalid pattern given
-            irc.out.notice(nickname, f"sed: regexp error: {e}")
-            return
+    try:
+        sed = sed_compile(sed_args[1], sed_args[2], sed_args[3])
+    except re.error as e:  # Invalid pattern or flags given
+        irc.out.notice(nickname, f"sed: regexp error: {e}")
+        return
 
-        if db_search:
-            if goback:
-                # Check if the goback command was issued.
-                goback -= 1
-                n = n + 1
-                continue
-            a = n
-            break
-        else:
-            a = False
-        n = n + 1
+    if target:
+        matches = history_matches(sed[0], msgtarget, target,
+                                  only_nickname=True)
+    else:
+        matches = history_matches(sed[0], msgtarget, nickname)
+    author, msg = next(islice(matches, goback, None), (None, None))
 
-    if a:
-        if "\x01ACTION " in msglist[-a][:8]:
+    if msg is not None:
+        if "\x01ACTION " in msg[:8]:
             msg_len = irc.msg_len - 9 - len(msgtarget) - 10 - 2
-            sed_out = call_sed(msglist[-a][8:], sed_args).strip()
-            sed_out = sed_out.rstrip('\n').replace('\x01', "")
+            sed_out = sed_substitute(sed, msg[8:]).strip()
+            sed_out = sed_out.replace('\x01', "")
             sed_out = p_truncate(sed_out, msg_len, 98, True)
             irc.out.privmsg(msgtarget, f"\x01ACTION {sed_out}\x01")
         else:
             msg_len = irc.msg_len - 9 - len(msgtarget) - 2
-            sed_out = call_sed(msglist[-a], sed_args).strip()
-            sed_out = sed_out.rstrip('\n').replace('\x01', "")
+            sed_out = sed_substitute(sed, msg).strip()
+            sed_out = sed_out.replace('\x01', "")
             sed_out = p_truncate(sed_out, msg_len, 98, True)
             irc.out.privmsg(msgtarget, sed_out)
 
     if sed_out:
-        # We try to limit the string saved in the queue to avoid:
-        # OSError: [Errno 7] Argument list too long: 'echo'
-        # when calling 'echo' in @call_sed .
-        # 512 chars are more than enough, since the bot will
-        # never be able to send a message with that many.
-        write(i.varget, i.varset, msgtarget, sed_out)
-    # write(i.varget, i.varset, msgtarget, text) # save commands
+        # Saved as a message of the author of the corrected message
+        write(msgtarget, author, sed_out)
+    # write(msgtarget, nickname, text) # save commands
@@ -27,11 +27,17 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
-from datetime import datetime, timezone
+import atexit
+import string
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 from dbothelper import is_ascii_cl, get_day_str, get_month_str  # type: ignore
 from admin import is_bot_owner  # type: ignore
+from sqlhelper import upsert_sql, use_profile
 
 
 class Module:
@@ -44,34 +50,138 @@ class Module:
                  " will show that channel. Private messages with the bot"
                  " are NOT saved."),
         "bot_commands": {
-            "seen": {"usage": lambda x: f"{x}seen <nickname>"},
+            "seen": {"usage": lambda x: f"{x}seen <nickname> [--activity]"},
             "info": ("Example: <Alice>: .seen Bob / <Bot>:"
                      " Bob was last seen 0:21:09 ago"
-                     " [2018-06-25 13:36:42 UTC], saying .help seen")
+                     " [2018-06-25 13:36:42 UTC], saying .help seen"
+                     " | --activity shows the hours Bob is usually"
+                     " around. | .seen Bo* or .seen *ob lists the most"
+                     " recent nicknames that start or end with Bo/ob.")
         }
     }
 
 
-def update(db, channel, nickname, message):
-    timestamp = str(datetime.utcnow().replace(microsecond=0))
+# ----- Constants ----- #
+flush_interval = 5  # Seconds between the writes of the seen updates
+flush_count = 500  # Nicknames pending before a write is forced
+match_limit = 10  # Nicknames listed for `.seen nick*' and `.seen *nick'
+activity_bars = " \u2581\u2582\u2583\u2584\u2585\u2586\u2587\u2588"
+# --------------------- #
+
+
+# Updates are cached in memory and written to the database in batches,
+# so a channel message does not cost a transaction of its own. The
+# caches are keyed like the NOCASE columns: ASCII letters only are case
+# folded. The fetch functions read through them.
+#
+# Three tables are kept up to date:
+#   seen:          the last message of a nick in any channel
+#   seen_channels: the last message of a nick in each channel
+#   seen_activity: messages of a nick per UTC hour of the day
 
-    with db:
-        dbc = db.cursor()
+seen_pending = {}  # folded nick -> (nick, msg, time, channel)
+channels_pending = {}  # (folded nick, folded channel) -> same as above
+activity_pending = {}  # (folded nick, hour) -> [nick, messages]
+seen_flushing = {}  # Updates being written by flush()
+channels_flushing = {}
+activity_flushing = {}
+seen_last_flush = time.monotonic()
+seen_lock = threading.Lock()
+seen_db = None  # Connection used for the flush at exit
 
-        sql = """
-            INSERT OR IGNORE INTO seen (nick, msg, time, channel)
-            VALUES (?, ?, ?, ?);
-        """
-        dbc.execute(sql, (nickname, message, timestamp, channel))
+nocase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
 
-        sql = """
-            UPDATE seen SET msg=?, time=?, channel=?
-            WHERE nick=?;
-        """
-        dbc.execute(sql, (message, timestamp, channel, nickname))
+
+def update(db, channel, nickname, message):
+    now = int(time.time())
+    hour = now // 3600 % 24
+    row = (nickname, message, now, channel)
+    key = nickname.translate(nocase)
+
+    with seen_lock:
+        seen_pending[key] = row
+        channels_pending[(key, channel.translate(nocase))] = row
+        try:
+            activity_pending[(key, hour)][1] += 1
+        except KeyError:
+            activity_pending[(key, hour)] = [nickname, 1]
+
+
+def flush_due():
+    with seen_lock:
+        return (len(seen_pending) >= flush_count
+                or (seen_pending and time.monotonic() - seen_last_flush
+                    >= flush_interval))
+
+
+def flush(db):
+    global seen_pending, channels_pending, activity_pending
+    global seen_flushing, channels_flushing, activity_flushing
+    global seen_last_flush
+
+    with seen_lock:
+        seen_flushing, seen_pending = seen_pending, {}
+        channels_flushing, channels_pending = channels_pending, {}
+        activity_flushing, activity_pending = activity_pending, {}
+        seen_last_flush = time.monotonic()
+
+    if not seen_flushing:
+        return
+
+    try:
+        with db:
+            dbc = db.cursor()
+            sql = upsert_sql("seen", ("nick",),
+                             ("msg", "time", "channel", "rnick"))
+            dbc.executemany(sql, ((*row, row[0][::-1])
+                                  for row in seen_flushing.values()))
+            sql = upsert_sql("seen_channels", ("nick", "channel"),
+                             ("msg", "time"))
+            dbc.executemany(sql, ((nick, channel, msg, t)
+                                  for nick, msg, t, channel
+                                  in channels_flushing.values()))
+            sql = """
+                INSERT INTO seen_activity (nick, hour, messages)
+                VALUES (?, ?, ?)
+                ON CONFLICT (nick, hour) DO UPDATE
+                SET messages = messages + excluded.messages;
+            """
+            dbc.executemany(sql, ((nick, hour, messages)
+                                  for (_, hour), (nick, messages)
+                                  in activity_flushing.items()))
+    except Exception:
+        with seen_lock:
+            # Keep the updates that were not written, unless they have
+            # been superseded in the meantime.
+            for key, value in seen_flushing.items():
+                seen_pending.setdefault(key, value)
+            for key, value in channels_flushing.items():
+                channels_pending.setdefault(key, value)
+            for key, (nick, messages) in activity_flushing.items():
+                activity_pending.setdefault(key, [nick, 0])[1] += messages
+        raise
+    finally:
+        with seen_lock:
+            seen_flushing = {}
+            channels_flushing = {}
+            activity_flushing = {}
+
+
+def flush_atexit():
+    if seen_db is not None:
+        flush(seen_db)
+
+
+atexit.register(flush_atexit)
 
 
 def fetch(db, nickname):
+    key = nickname.translate(nocase)
+    with seen_lock:
+        cached = seen_pending.get(key) or seen_flushing.get(key)
+    if cached:
+        return cached
+
     dbc = db.cursor()
     sql = """
         SELECT nick, msg, time, channel
@@ -81,14 +191,94 @@ def fetch(db, nickname):
     return dbc.fetchone()
 
 
+def fetch_matching(db, pattern):
+    """Return the most recent nicknames that match `pattern', which is
+    either prefix* or *suffix.
+
+    Prefixes are looked up with a range on the nick primary key and
+    suffixes with a range on the reversed nick column.
+    """
+    if pattern.endswith("*"):
+        column, start = "nick", pattern[:-1]
+        matches = str.startswith
+    else:
+        column, start = "rnick", pattern[:0:-1]
+        matches = str.endswith
+    start = start.translate(nocase)
+    part = start if column == "nick" else start[::-1]
+
+    # The smallest string after every string that starts with `start'
+    # when compared with NOCASE, where A-Z are equal to a-z.
+    last = chr(ord(start[-1]) + 1)
+    if last == "A":
+        last = "["
+    end = start[:-1] + last
+
+    dbc = db.cursor()
+    sql = f"""
+        SELECT nick, msg, time, channel FROM seen
+        WHERE {column} >= ? AND {column} < ?
+        ORDER BY +time DESC LIMIT ?;
+    """
+    dbc.execute(sql, (start, end, match_limit))
+    rows = {row[0].translate(nocase): row for row in dbc.fetchall()}
+
+    with seen_lock:
+        for pending in (seen_flushing, seen_pending):
+            for key, row in pending.items():
+                if matches(key, part):
+                    rows[key] = row
+
+    rows = sorted(rows.values(), key=lambda row: row[2], reverse=True)
+    return rows[:match_limit]
+
+
+def fetch_channel(db, nickname, channel):
+    key = (nickname.translate(nocase), channel.translate(nocase))
+    with seen_lock:
+        cached = channels_pending.get(key) or channels_flushing.get(key)
+    if cached:
+        return cached
+
+    dbc = db.cursor()
+    sql = """
+        SELECT nick, msg, time, channel
+        FROM seen_channels WHERE nick=? AND channel=?;
+    """
+    dbc.execute(sql, (nickname, channel))
+    return dbc.fetchone()
+
+
+def fetch_activity(db, nickname):
+    """Return the number of messages of `nickname' for every UTC hour."""
+    hours = [0] * 24
+
+    dbc = db.cursor()
+    sql = """
+        SELECT hour, messages FROM seen_activity WHERE nick=?;
+    """
+    dbc.execute(sql, (nickname,))
+    for hour, messages in dbc:
+        hours[hour] += messages
+
+    key = nickname.translate(nocase)
+    with seen_lock:
+        for pending in (activity_pending, activity_flushing):
+            for hour in range(24):
+                if (key, hour) in pending:
+                    hours[hour] += pending[(key, hour)][1]
+
+    return hours
+
+
 # Output message preparation for .seen ###############################
 
-def prep_message(i, fetchdata):
+def prep_message(i, fetchdata, here=None):
     msgtarget = i.msg.get_msgtarget()
     nickname = i.msg.get_nickname()
 
     requested_nick, msg, timestamp, channel = fetchdata
-    ago, weekday, day, month, year, time, tz = prep_datetime(i, timestamp)
+    ago, weekday, day, month, year, clock, tz = prep_datetime(i, timestamp)
     is_ctcp_action, msg = prep_ctcp_action(msg)
 
     m = "\x0312"
@@ -99,7 +289,7 @@ def prep_message(i, fetchdata):
         m += f"{requested_nick}\x0F was"
 
     m += (f" last seen \x0312{ago} ago\x0F"
-          f" [{weekday} {day} {month} {year} {time} {tz}]")
+          f" [{weekday} {day} {month} {year} {clock} {tz}]")
 
     if is_ctcp_action:
         m += ", doing"
@@ -110,30 +300,74 @@ def prep_message(i, fetchdata):
 
     if channel != msgtarget:
         m += f" in \x0312{channel}"
+        if here:
+            ago = prep_datetime(i, here[2])[0]
+            m += f"\x0F, and here \x0312{ago} ago"
 
     return m
 
 
-def prep_datetime(i, timestamp):
-    conf = i.bot["conf"]
+def prep_matching(i, irc, pattern, rows):
+    m = f"Last seen matching \x0312{pattern}\x0F:"
+    for n, (nick, _msg, timestamp, channel) in enumerate(rows):
+        ago = prep_datetime(i, timestamp)[0]
+        entry = f" \x0312{nick}\x0F {ago} ago in {channel}"
+        if n and len((m + entry).encode()) > irc.msg_len - 100:
+            break
+        m += entry if not n else f",{entry}"
+    return m
+
+
+def prep_activity(i, requested_nick, hours):
+    # The hours are stored in UTC. Shift them to the configured timezone
+    # using its current offset.
+    tz, tzinfo = get_timezone(i)
+    shift = round(datetime.now(tzinfo).utcoffset().total_seconds() / 3600)
+    hours = hours[-shift % 24:] + hours[:-shift % 24]
+
+    peak = max(hours)
+    if not peak:
+        return (f"No activity of \x0312{requested_nick}\x0F"
+                " has been recorded yet")
+
+    bars = "".join(activity_bars[(n * (len(activity_bars) - 1) + peak - 1)
+                                 // peak] for n in hours)
+    busiest = hours.index(peak)
 
-    d = datetime.fromisoformat(f"{timestamp}+00:00")
+    return (f"Activity of \x0312{requested_nick}\x0F by hour ({tz}):"
+            f" 00 {bars} 23 | Most active at \x0312{busiest:02}:00\x0F"
+            f" | {sum(hours)} messages")
 
-    ago = datetime.now(timezone.utc).replace(microsecond=0) - d
 
-    # Get the timezone from the config file and convert the datetime object
-    # or remain in UTC
+@lru_cache(maxsize=8)
+def get_zoneinfo(tz):
+    return ZoneInfo(tz)
+
+
+def get_timezone(i):
+    """Return the name and tzinfo of the timezone in the config file
+    or UTC.
+    """
+    conf = i.bot["conf"]
     try:
         tz = conf.conf["ui"]["timezone"]
-        # Add the timezone to get a timezone aware object
-        d = d.astimezone(tz=ZoneInfo(tz))
+        return tz, get_zoneinfo(tz)
     except KeyError:
-        tz = "UTC"
+        return "UTC", timezone.utc
+
 
-    weekday = get_day_str(d.weekday())
-    month = get_month_str(d.month)
+weekdays = [get_day_str(n) for n in range(7)]
+months = [None] + [get_month_str(n) for n in range(1, 13)]
 
-    return ago, weekday, d.day, month, d.year, d.time(), tz
+
+def prep_datetime(i, timestamp):
+    ago = timedelta(seconds=int(time.time()) - timestamp)
+
+    tz, tzinfo = get_timezone(i)
+    d = datetime.fromtimestamp(timestamp, tzinfo)
+
+    return ago, weekdays[d.weekday()], d.day, months[d.month], d.year, \
+        d.time(), tz
 
 
 def prep_ctcp_action(message):
@@ -159,14 +393,37 @@ def seen(i, irc, db):
     args = i.msg.get_args()
 
     argv = args.split()
+    activity = "--activity" in argv
+    if activity:
+        argv.remove("--activity")
     argc = len(argv)
 
-    if not args:
+    if not argv:
         requested_nick = nickname
-    elif (argc == 1 and len(args) <= 30):
+    elif (argc == 1 and len(argv[0]) <= 30):
         requested_nick = argv[0]
     else:
-        m = f"Usage: {prefix}{botcmd} <nickname>"
+        requested_nick = None
+
+    # Patterns are prefix* or *suffix
+    is_pattern = requested_nick and "*" in requested_nick
+    if is_pattern and (activity or len(requested_nick) < 2
+                       or requested_nick.count("*") != 1
+                       or "*" not in (requested_nick[0], requested_nick[-1])):
+        requested_nick = None
+
+    if not requested_nick:
+        m = (f"Usage: {prefix}{botcmd} <nickname> [--activity]"
+             f" | {prefix}{botcmd} <prefix*> | {prefix}{botcmd} <*suffix>")
+        irc.out.notice(msgtarget, m)
+        return
+
+    if is_pattern:
+        rows = fetch_matching(db, requested_nick)
+        if not rows:
+            m = f"Sorry, I haven't seen \x0312{requested_nick}\x0F around"
+        else:
+            m = prep_matching(i, irc, requested_nick, rows)
         irc.out.notice(msgtarget, m)
         return
 
@@ -180,30 +437,115 @@ def seen(i, irc, db):
 
     if not seen:
         m = f"Sorry, I haven't seen \x0312{requested_nick}\x0F around"
-        irc.out.notice(msgtarget, m)
+    elif activity:
+        m = prep_activity(i, seen[0], fetch_activity(db, requested_nick))
     else:
-        m = prep_message(i, seen)
-        irc.out.notice(msgtarget, m)
+        here = fetch_channel(db, requested_nick, msgtarget)
+        m = prep_message(i, seen, here)
+
+    irc.out.notice(msgtarget, m)
 
 
 # Main ###############################################################
 
-def init(db):
-    dbc = db.cursor()
-    sql = """
+seen_tables = {
+    "seen": """
         CREATE TABLE IF NOT EXISTS seen (
                nick TEXT COLLATE NOCASE PRIMARY KEY,
                msg TEXT,
-               time TEXT,
-               channel TEXT
+               time INTEGER,
+               channel TEXT,
+               rnick TEXT COLLATE NOCASE
         );
+    """,
+    "seen_channels": """
+        CREATE TABLE IF NOT EXISTS seen_channels (
+               nick TEXT COLLATE NOCASE,
+               channel TEXT COLLATE NOCASE,
+               msg TEXT,
+               time INTEGER,
+               PRIMARY KEY(nick, channel)
+        ) WITHOUT ROWID;
+    """,
+    "seen_activity": """
+        CREATE TABLE IF NOT EXISTS seen_activity (
+               nick TEXT COLLATE NOCASE,
+               hour INTEGER,
+               messages INTEGER,
+               PRIMARY KEY(nick, hour)
+        ) WITHOUT ROWID;
+    """
+}
+
+
+def migrate_time(dbc, table):
+    """Rebuild `table' if its time column still holds ISO 8601 strings,
+    converting them to seconds since the epoch.
+    """
+    dbc.execute(f"PRAGMA table_info({table});")
+    columns = [(c[1], c[2]) for c in dbc.fetchall()]
+    if ("time", "TEXT") not in columns:
+        return
+
+    names = ", ".join(name for name, _ in columns)
+    values = ", ".join("CAST(strftime('%s', time) AS INTEGER)"
+                       if name == "time" else name for name, _ in columns)
+    dbc.executescript(f"""
+        BEGIN;
+        ALTER TABLE {table} RENAME TO {table}_text;
+        {seen_tables[table]}
+        INSERT INTO {table} ({names}) SELECT {values} FROM {table}_text;
+        DROP TABLE {table}_text;
+        COMMIT;
+    """)
+
+
+def init(db):
+    use_profile(db)
+    dbc = db.cursor()
+    for table, sql in seen_tables.items():
+        dbc.execute(sql)
+    db.commit()
+
+    # Migration code :: added 2026/10/17
+    migrate_time(dbc, "seen")
+    migrate_time(dbc, "seen_channels")
+
+    # Migration code :: added 2026/10/17
+    # rnick is the reversed nick, used for `.seen *suffix'.
+    dbc.execute("PRAGMA table_info(seen);")
+    if not any(c[1] == "rnick" for c in dbc.fetchall()):
+        dbc.execute("ALTER TABLE seen ADD COLUMN rnick TEXT COLLATE NOCASE;")
+    db.create_function("seen_reverse", 1, lambda s: s[::-1],
+                       deterministic=True)
+    sql = """
+        UPDATE seen SET rnick = seen_reverse(nick) WHERE rnick IS NULL;
+    """
+    dbc.execute(sql)
+
+    # Start the per channel table from what is already known.
+    sql = """
+        INSERT INTO seen_channels (nick, channel, msg, time)
+        SELECT nick, channel, msg, time FROM seen
+        WHERE NOT EXISTS (SELECT 1 FROM seen_channels);
+    """
+    dbc.execute(sql)
+    sql = """
+        CREATE INDEX IF NOT EXISTS seen_i_time ON seen (time);
+    """
+    dbc.execute(sql)
+    sql = """
+        CREATE INDEX IF NOT EXISTS seen_i_rnick ON seen (rnick);
     """
     dbc.execute(sql)
     db.commit()
 
 
 def main(i, irc):
+    global seen_db
+
     db = i.db_disk
+    seen_db = db
 
     # Database initialization on startup
     if i.msg.is_command("__STARTUP"):
@@ -229,3 +571,6 @@ def main(i, irc):
     # Save user messages.
     if not is_pm:  # PMs with the bot are not saved.
         update(db, msgtarget, nickname, text)
+
+    if flush_due():
+        flush(db)
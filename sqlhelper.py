@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# coding=utf-8
+
+# SQLite helpers for Drastikbot modules
+#
+# This is not a module by itself. It holds the database code shared by
+# the modules that keep per nickname settings and activity.
+
+'''
+Copyright (C) 2021 drastik.org
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+import sqlite3
+import threading
+from functools import lru_cache
+
+
+# ----- Constants ----- #
+# Applied once to every connection passed to use_profile()
+profile = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA cache_size=-8192;",  # KiB
+    "PRAGMA temp_store=MEMORY;",
+)
+# --------------------- #
+
+profiled = set()  # id() of the connections the profile was applied to
+profile_lock = threading.Lock()
+
+
+def use_profile(db):
+    """Apply the connection profile to `db', if not already done.
+
+    The journal mode cannot be changed inside a transaction, so when
+    one is open the profile is applied on a later call instead.
+    """
+    if id(db) in profiled:
+        return
+
+    with profile_lock:
+        if id(db) in profiled or db.in_transaction:
+            return
+        dbc = db.cursor()
+        for pragma in profile:
+            dbc.execute(pragma)
+        profiled.add(id(db))
+
+
+def connect(db):
+    """Open a new connection to the database file of `db'.
+
+    The bot shares one connection between the modules, and a commit on
+    it saves any transaction that is open on it. A worker thread or a
+    long transaction uses its own connection instead.
+    """
+    dbc = db.cursor()
+    dbc.execute("PRAGMA database_list;")
+    path = dbc.fetchone()[2]  # (seq, name, file) of the main database
+    if not path:
+        raise ValueError("an in-memory database cannot be shared")
+    conn = sqlite3.connect(path, check_same_thread=False)
+    # Not through use_profile(): once closed, the id() of the connection
+    # can be reused by another one, which would then be skipped.
+    try:
+        for pragma in profile:
+            conn.execute(pragma)
+    except sqlite3.OperationalError:
+        pass  # Locked by another connection, the profile is optional
+    return conn
+
+
+@lru_cache(maxsize=64)
+def upsert_sql(table, keys, columns):
+    """Return an INSERT statement for `table' that updates `columns'
+    of the row when one with the same `keys' already exists.
+
+    The parameters are the values of `keys' followed by the values of
+    `columns'. `keys' must match a PRIMARY KEY or UNIQUE index.
+    """
+    names = keys + columns
+    return (f"INSERT INTO {table} ({', '.join(names)})"
+            f" VALUES ({', '.join('?' * len(names))})"
+            f" ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+            + ", ".join(f"{c}=excluded.{c}" for c in columns) + ";")
+
+
+def upsert(dbc, table, keys, values):
+    """Insert or update a row of `table'.
+
+    keys:   {column: value} of the PRIMARY KEY or UNIQUE columns
+    values: {column: value} of the columns to set
+    """
+    sql = upsert_sql(table, tuple(keys), tuple(values))
+    dbc.execute(sql, (*keys.values(), *values.values()))
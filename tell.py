@@ -28,11 +28,18 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+import hashlib
+import queue
+import string
+import threading
+import time
 from datetime import datetime, timezone
+from functools import lru_cache
 from zoneinfo import ZoneInfo
 
 from dbothelper import is_ascii_cl, get_day_str, get_month_str  # type: ignore
 from ignore import is_ignored  # type: ignore
+from sqlhelper import connect
 
 # Try to import the url module from drastikbot_modules to provide url titles.
 try:
@@ -54,11 +61,155 @@ class Module:
         ),
         "bot_commands": {
             "tell": {"usage": lambda x: f"{x}tell <receiver> <message>"},
-            "yell": {"usage": lambda x: f"{x}yell <receiver> <message>"}
+            "yell": {"usage": lambda x: f"{x}yell <receiver> <message>"},
+            "tells": {
+                "usage": lambda x: f"{x}tells more",
+                "info": "Show the tells that did not fit in the first lines."
+            }
         }
     }
 
 
+# ----- Constants ----- #
+expiry = 3600 * 24 * 30 * 3  # Seconds before an undelivered tell is deleted
+purge_interval = 3600  # Seconds between the deletions of expired tells
+purge_batch = 500  # Expired tells deleted per transaction
+sender_quota = 20  # Undelivered tells a nickname can have sent
+receiver_quota = 50  # Undelivered tells a nickname can receive
+dedupe_window = 3600 * 24  # Seconds in which a repeated tell is refused
+titles_limit = 3  # URL titles looked up per tell
+titles_attempts = 3  # Failed lookups before a tell waits for a restart
+page_lines = 4  # Lines of tells sent at once, the rest wait for .tells more
+send_rate = 0.5  # Lines per second sent after a burst
+send_burst = 5  # Lines sent without waiting
+# --------------------- #
+
+
+# ====================================================================
+# Pending receivers
+# ====================================================================
+
+# find() runs for every message posted. To avoid querying the database
+# each time, the receivers with pending tells are kept in a set, folded
+# like the NOCASE receiver column: only ASCII letters are case folded.
+# The set may keep receivers whose tells have expired. find() removes
+# them when it finds nothing for them.
+
+receivers = set()
+receivers_loaded = False
+receivers_lock = threading.Lock()
+purge_last = time.monotonic()
+
+nocase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+def load_receivers(db):
+    global receivers_loaded
+
+    dbc = db.cursor()
+    dbc.execute("SELECT DISTINCT receiver FROM tell;")
+    with receivers_lock:
+        receivers.update(r.translate(nocase) for (r,) in dbc.fetchall())
+        receivers_loaded = True
+
+
+def purge_due():
+    return time.monotonic() - purge_last >= purge_interval
+
+
+def purge(db):
+    """Delete the expired tells, `purge_batch' at a time so that the
+    other writers are not kept waiting.
+    """
+    global purge_last
+
+    purge_last = time.monotonic()
+    cutoff = int(time.time()) - expiry
+    dbc = db.cursor()
+    sql = """
+        DELETE FROM tell WHERE id IN (
+            SELECT id FROM tell WHERE date < ? LIMIT ?);
+    """
+    while True:
+        dbc.execute(sql, (cutoff, purge_batch))
+        db.commit()
+        if dbc.rowcount < purge_batch:
+            break
+
+
+# ====================================================================
+# URL titles
+# ====================================================================
+
+# The titles of the URLs in a tell are looked up when it is stored, by
+# a background worker, and saved in the `titles' column separated by
+# newlines. NULL means they have not been looked up yet. Delivery only
+# reads the column and never waits for a website.
+#
+# The worker writes on a connection of its own. A commit on the bot's
+# shared connection would also save the transaction another module has
+# open on it.
+
+titles_queue = queue.Queue()  # (id, msg, attempts) of the tells to look up
+titles_thread = None
+titles_lock = threading.Lock()
+
+
+def titles_enqueue(db, tell_id, msg):
+    global titles_thread
+
+    with titles_lock:
+        if titles_thread is None or not titles_thread.is_alive():
+            titles_thread = threading.Thread(target=titles_worker,
+                                             args=(connect(db),),
+                                             daemon=True)
+            titles_thread.start()
+    titles_queue.put((tell_id, msg, 0))
+
+
+def titles_worker(db):
+    while True:
+        tell_id, msg, attempts = titles_queue.get()
+        try:
+            titles_update(db, tell_id, msg)
+        except Exception:
+            db.rollback()
+            # Try again after the rest of the queue. A tell that keeps
+            # failing stays NULL and is retried by titles_resume().
+            if attempts + 1 < titles_attempts:
+                titles_queue.put((tell_id, msg, attempts + 1))
+
+
+def titles_update(db, tell_id, msg):
+    titles = [title for status, title
+              in url.get_titles_from_text(msg, limit=titles_limit)
+              if status == "title"]
+
+    # The tell may have been delivered in the meantime, in which case
+    # there is nothing to update.
+    dbc = db.cursor()
+    sql = """
+        UPDATE tell SET titles=? WHERE id=?;
+    """
+    dbc.execute(sql, ("\n".join(titles), tell_id))
+    db.commit()
+
+
+def has_urls(msg):
+    return url_support and any(url.get_urls_from_text(msg))
+
+
+def titles_resume(db):
+    """Look up the titles of the tells stored before the bot stopped
+    that were not looked up yet.
+    """
+    dbc = db.cursor()
+    dbc.execute("SELECT id, msg FROM tell WHERE titles IS NULL;")
+    for tell_id, msg in dbc.fetchall():
+        if has_urls(msg):
+            titles_enqueue(db, tell_id, msg)
+
+
 # ====================================================================
 # Insert messages in the db
 # ====================================================================
@@ -92,6 +243,11 @@ def add(i, irc, upper=False):
     if is_ignored(i, irc, receiver, nickname):
         return  # do not say anything
 
+    m = db_check(i, receiver, message, nickname)
+    if m:
+        irc.out.notice(msgtarget, f"{nickname}: {m}")
+        return
+
     db_insert(i, receiver, message, nickname, msgtarget)
 
     if i.msg.is_nickname(receiver):
@@ -102,18 +258,57 @@ def add(i, irc, upper=False):
         irc.out.notice(msgtarget, m)
 
 
+def tell_hash(receiver, msg, sender):
+    """64 bit hash of a tell, stored as tell.hash to find repeats"""
+    data = "\0".join((receiver.translate(nocase), msg,
+                      sender.translate(nocase)))
+    h = hashlib.blake2b(data.encode(), digest_size=8)
+    return int.from_bytes(h.digest(), "big", signed=True)
+
+
+def db_check(i, receiver, msg, sender):
+    """Return why the tell cannot be stored, or None if it can."""
+    dbc = i.db_disk.cursor()
+    sql = """
+        SELECT (SELECT count(*) FROM tell WHERE sender=? COLLATE NOCASE),
+               (SELECT count(*) FROM tell WHERE receiver=?),
+               EXISTS (SELECT 1 FROM tell WHERE hash=? AND date>=?);
+    """
+    dbc.execute(sql, (sender, receiver, tell_hash(receiver, msg, sender),
+                      int(time.time()) - dedupe_window))
+    sent, received, repeated = dbc.fetchone()
+
+    if repeated:
+        return f"I will already tell {receiver} that."
+    if sent >= sender_quota:
+        return ("You have sent too many messages that are not delivered"
+                " yet.")
+    if received >= receiver_quota:
+        return f"{receiver} has too many messages waiting already."
+    return None
+
+
 def db_insert(i, receiver, msg, sender, msgtarget):
     db = i.db_disk
     dbc = db.cursor()
 
-    timestamp = datetime.utcnow().replace(microsecond=0)
+    lookup = has_urls(msg)
     sql = """
-        INSERT INTO tell VALUES (?, ?, ?, ?, strftime('%s', 'now'), ?);
+        INSERT INTO tell (receiver, msg, sender, date, channel, titles, hash)
+        VALUES (?, ?, ?, ?, ?, ?, ?);
     """
-    dbc.execute(sql, (receiver, msg, sender, str(timestamp), msgtarget))
+    dbc.execute(sql, (receiver, msg, sender, int(time.time()), msgtarget,
+                      None if lookup else "",
+                      tell_hash(receiver, msg, sender)))
 
     db.commit()
 
+    if lookup:
+        titles_enqueue(db, dbc.lastrowid, msg)
+
+    with receivers_lock:
+        receivers.add(receiver.translate(nocase))
+
 
 # ====================================================================
 # Pull messages from the db
@@ -121,60 +316,155 @@ def db_insert(i, receiver, msg, sender, msgtarget):
 
 def find(i, irc):
     db = i.db_disk
-    dbc = db.cursor()
     nick = i.msg.get_nickname()
 
+    if not receivers_loaded:
+        load_receivers(db)
+
+    key = nick.translate(nocase)
+    with receivers_lock:
+        if key not in receivers:
+            return
+        receivers.discard(key)
+
+    deliver(i, irc, nick)
+
+
+def more(i, irc):
+    msgtarget = i.msg.get_msgtarget()
+    nick = i.msg.get_nickname()
+
+    if not deliver(i, irc, nick):
+        irc.out.notice(msgtarget, f"{nick}: You have no more tells.")
+
+
+def deliver(i, irc, nick):
+    """Send a page of the tells of `nick'. Return False if there were
+    none.
+    """
+    db = i.db_disk
+    dbc = db.cursor()
     sql = """
-        SELECT sender, msg, timestamp, channel FROM tell WHERE receiver=?;
+        SELECT id, sender, msg, date, channel, titles
+        FROM tell WHERE receiver=? ORDER BY date, id;
     """
     dbc.execute(sql, (nick,))
 
     fetch = dbc.fetchall()
     if not fetch:
-        return
+        return False
 
-    for x in fetch:
+    lines, sent = plan_delivery(i, irc, nick, fetch)
+    for line in lines:
+        send(irc, nick, line)
+
+    left = len(fetch) - len(sent)
+    if left:
+        prefix = i.bot["conf"].get_channel_prefix(i.msg.get_msgtarget())
+        send(irc, nick, f"You have \x0312{left}\x0F more tells."
+                        f" Use \x0312{prefix}tells more\x0F to read them.")
+
+    # Only the tells that were sent are deleted. Any tell stored since
+    # the SELECT is found on the next message.
+    dbc.executemany("DELETE FROM tell WHERE id=?;",
+                    [(tell_id,) for tell_id in sent])
+
+    db.commit()
+    return True
+
+
+def plan_delivery(i, irc, nick, rows):
+    """Pack the tells in `rows' in as few lines as possible.
+
+    Return the lines and the ids of the tells in them. The tells
+    that do not fit in `page_lines' lines are left out, except for the
+    first one which is always sent.
+    """
+    # PRIVMSG <nick> :<line>\r\n
+    budget = irc.msg_len - 9 - len(nick) - 2
+    sep = " \x0315|\x0F "
+
+    lines = []
+    line = ""
+    sent = []
+    for tell_id, *x, titles in rows:
         header, msg = prep_message(i, x)
-        irc.out.privmsg(nick, header)
-        irc.out.privmsg(nick, msg)
+        parts = [f"{header} {msg}"]
+        if len(parts[0].encode()) > budget:
+            parts = [header, msg]
         # Also show the titles for any urls in the msg
-        if not url_support:
-            continue
-        for (_status, title) in url.get_titles_from_text(msg, limit=3):
-            irc.out.privmsg(nick, title)
+        parts += (titles or "").splitlines()
 
-    dbc.execute("DELETE FROM tell WHERE receiver=?;", (nick,))
-    # Delete messages older than 3600 * 24 * 30 * 3 seconds.
-    sql = """
-        DELETE FROM tell
-        WHERE (strftime('%s', 'now') - date) > (3600 * 24 * 30 * 3);
-    """
-    dbc.execute(sql)
+        tell_lines = lines.copy()
+        tell_line = line
+        for part in parts:
+            if tell_line and len((tell_line + sep + part).encode()) <= budget:
+                tell_line += sep + part
+                continue
+            if tell_line:
+                tell_lines.append(tell_line)
+            tell_line = part
 
-    db.commit()
+        if sent and len(tell_lines) + 1 > page_lines:
+            break
+        lines, line = tell_lines, tell_line
+        sent.append(tell_id)
+
+    if line:
+        lines.append(line)
+    return lines, sent
+
+
+# Token bucket shared by all the deliveries, so that a receiver with
+# many tells does not get the bot throttled by the server. The tokens
+# may go negative: each sender then waits for its own turn.
+bucket_tokens = send_burst
+bucket_time = time.monotonic()
+bucket_lock = threading.Lock()
+
+
+def send(irc, nick, line):
+    global bucket_tokens, bucket_time
+
+    with bucket_lock:
+        now = time.monotonic()
+        bucket_tokens = min(send_burst, bucket_tokens
+                            + (now - bucket_time) * send_rate)
+        bucket_time = now
+        bucket_tokens -= 1
+        wait = max(0, -bucket_tokens / send_rate)
+
+    if wait:
+        time.sleep(wait)
+    irc.out.privmsg(nick, line)
+
+
+@lru_cache(maxsize=8)
+def get_zoneinfo(tz):
+    return ZoneInfo(tz)
+
+
+weekdays = [get_day_str(n) for n in range(7)]
+months = [None] + [get_month_str(n) for n in range(1, 13)]
 
 
 def prep_message(i, fetchdata):
     conf = i.bot["conf"]
-    sender, msg, timestamp, channel = fetchdata
+    sender, msg, date, channel = fetchdata
 
-    d = datetime.fromisoformat(f"{timestamp}+00:00")
-
-    # Get the timezone from the config file and convert the datetime object
-    # or remain in UTC
+    # Get the timezone from the config file or remain in UTC
     try:
         tz = conf.conf["ui"]["timezone"]
-        # Add the timezone to get a timezone aware object
-        d = d.astimezone(tz=ZoneInfo(tz))
+        tzinfo = get_zoneinfo(tz)
     except KeyError:
         tz = "UTC"
+        tzinfo = timezone.utc
 
-    weekday = get_day_str(d.weekday())
-    month = get_month_str(d.month)
+    d = datetime.fromtimestamp(date, tzinfo)
 
     header = (f'\x02\x0312{sender}\x0F'
-              f' \x0315[{weekday} {d.day} {month} {d.year}'
-              f' {d.time()} {tz}]\x0F')
+              f' \x0315[{weekdays[d.weekday()]} {d.day} {months[d.month]}'
+              f' {d.year} {d.time()} {tz}]\x0F')
     if sender == channel:
         header += " \x0304[Private]\x0F:"
     else:
@@ -186,25 +476,78 @@ def prep_message(i, fetchdata):
 # Intialization / Migrations
 # ====================================================================
 
-def db_init(i):
-    db = i.db_disk
-    dbc = db.cursor()
-
-    dbc.executescript("""
+tell_table = """
     CREATE TABLE IF NOT EXISTS tell (
+        id        INTEGER PRIMARY KEY AUTOINCREMENT,
         receiver  TEXT COLLATE NOCASE,
         msg       TEXT,
         sender    TEXT,
-        timestamp TEXT,
         date      INTEGER,
-        channel   TEXT);
-    """)
+        channel   TEXT,
+        titles    TEXT,
+        hash      INTEGER);
+"""
+
+
+def db_init(i):
+    db = i.db_disk
+    dbc = db.cursor()
+
+    dbc.executescript(tell_table)
 
     # Migration code :: added 2022/20/4 :: delete after 2023/20/4
     dbc.execute("PRAGMA table_info(tell);")
-    if not any([x[1] == "channel" for x in dbc.fetchall()]):
+    columns = [x[1] for x in dbc.fetchall()]
+    if "channel" not in columns:
         dbc.execute("ALTER TABLE tell ADD COLUMN channel TEXT;")
 
+    # Migration code :: added 2026/10/17
+    # The `timestamp' column kept the date as an ISO 8601 string next to
+    # the `date' epoch column. Keep only the latter.
+    if "timestamp" in columns:
+        dbc.executescript(f"""
+            BEGIN;
+            ALTER TABLE tell RENAME TO tell_timestamp;
+            {tell_table}
+            INSERT INTO tell (receiver, msg, sender, date, channel)
+            SELECT receiver, msg, sender,
+                   coalesce(date, CAST(strftime('%s', timestamp) AS INTEGER)),
+                   channel
+            FROM tell_timestamp ORDER BY date;
+            DROP TABLE tell_timestamp;
+            COMMIT;
+        """)
+
+    # Migration code :: added 2026/10/17
+    dbc.execute("PRAGMA table_info(tell);")
+    columns = [x[1] for x in dbc.fetchall()]
+    if "titles" not in columns:
+        dbc.execute("ALTER TABLE tell ADD COLUMN titles TEXT;")
+    if "hash" not in columns:
+        dbc.execute("ALTER TABLE tell ADD COLUMN hash INTEGER;")
+
+    # Migration code :: added 2026/10/17
+    # Give the tells an id that is never reused.
+    if "id" not in columns:
+        dbc.executescript(f"""
+            BEGIN;
+            ALTER TABLE tell RENAME TO tell_noid;
+            {tell_table}
+            INSERT INTO tell (receiver, msg, sender, date, channel, titles,
+                              hash)
+            SELECT receiver, msg, sender, date, channel, titles, hash
+            FROM tell_noid ORDER BY date;
+            DROP TABLE tell_noid;
+            COMMIT;
+        """)
+
+    dbc.execute("CREATE INDEX IF NOT EXISTS tell_i_receiver"
+                " ON tell (receiver, date);")
+    dbc.execute("CREATE INDEX IF NOT EXISTS tell_i_date ON tell (date);")
+    dbc.execute("CREATE INDEX IF NOT EXISTS tell_i_sender"
+                " ON tell (sender COLLATE NOCASE);")
+    dbc.execute("CREATE INDEX IF NOT EXISTS tell_i_hash ON tell (hash);")
+
     db.commit()
 
 
@@ -220,6 +563,8 @@ def main(i, irc):
 
     if "__STARTUP" == botcmd:
         db_init(i)
+        load_receivers(i.db_disk)
+        titles_resume(i.db_disk)
         return
 
     msgtarget = i.msg.get_msgtarget()
@@ -227,6 +572,9 @@ def main(i, irc):
 
     find(i, irc)
 
+    if purge_due():
+        purge(i.db_disk)
+
     if i.msg.is_botcmd_prefix(ch_pfx):
         if "tell-initialize" == botcmd:
             db_init(i)
@@ -236,3 +584,6 @@ def main(i, irc):
 
         if "yell" == botcmd:
             add(i, irc, upper=True)
+
+        if "tells" == botcmd and i.msg.get_args().strip() == "more":
+            more(i, irc)
@@ -0,0 +1,37 @@
+# coding=utf-8
+
+# Helpers for running the module tests outside of drastikbot.
+#
+# The modules import a few drastikbot modules (irc.message, admin, ...)
+# that only exist inside the bot. When they cannot be imported, minimal
+# stand-ins are registered so that the modules can be imported here.
+
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday",
+        "Saturday", "Sunday"]
+stand_ins = {
+    "irc.message": {"remove_formatting": lambda text: text},
+    "admin": {"is_allowed": lambda *args: True,
+              "is_bot_owner": lambda *args: True},
+    "dbot_tools": {"p_truncate": lambda text, length, *args: text[:length]},
+    "dbothelper": {"is_ascii_cl": lambda a, b: a.lower() == b.lower(),
+                   "get_day_str": lambda day: days[day],
+                   "get_month_str": lambda month: str(month)},
+    "ignore": {"is_ignored": lambda *args: False},
+    "user_auth": {"user_auth": lambda *args, **kwargs: True},
+}
+
+for name, attrs in stand_ins.items():
+    try:
+        __import__(name)
+    except ImportError:
+        for part in ("irc",) if name.startswith("irc.") else ():
+            sys.modules.setdefault(part, types.ModuleType(part))
+        module = types.ModuleType(name)
+        module.__dict__.update(attrs)
+        sys.modules[name] = module
@@ -0,0 +1,259 @@
+# coding=utf-8
+
+# Tests for quote.py, run on an in-memory database.
+#
+# Run with pytest, or as a script to time the random quote pick against
+# ORDER BY RANDOM() on a synthetic 100k quote database:
+#     python3 tests/test_quote.py
+
+import json
+import random
+import re
+import sqlite3
+import time
+import types
+
+import pytest
+
+import support  # noqa: F401
+import quote
+
+
+@pytest.fixture
+def dbc():
+    db = sqlite3.connect(":memory:")
+    dbc = db.cursor()
+    quote.db_init(dbc)
+    db.commit()
+    yield dbc
+    db.close()
+
+
+def record(channel, text, **kwargs):
+    return {"channel": channel, "quote": text, "quotee": "nick",
+            "added_by": "adder", **kwargs}
+
+
+def test_import_channel_case(dbc):
+    # NOCASE folds ASCII only: "#Ä" and "#ä" are two channels.
+    quotes = [record("#Ä", "1"), record("#ä", "2"),
+              record("#A", "3"), record("#a", "4")]
+    assert quote.db_import_quotes(dbc, quotes) == 4
+    dbc.connection.commit()
+    assert quote.db_channel_seq(dbc, "#Ä") == 1
+    assert quote.db_channel_seq(dbc, "#ä") == 1
+    assert quote.db_channel_seq(dbc, "#A") == 2
+    assert quote.db_add_quote(dbc, "5", "nick", "adder", "#ä") == 2
+    assert quote.db_add_quote(dbc, "6", "nick", "adder", "#Ä") == 2
+
+
+@pytest.mark.parametrize("quotes, error", [
+    ([record("#a", "1"), record("#a", "2", quotee=None)], sqlite3.Error),
+    ([record("#a", "1"), ["not", "an", "object"]], TypeError),
+])
+def test_import_bad_records(dbc, quotes, error):
+    with pytest.raises(error):
+        quote.db_import_quotes(dbc, quotes)
+    dbc.execute("SELECT COUNT(*) FROM quote_quotes;")
+    assert dbc.fetchone()[0] == 0
+    dbc.execute("SELECT name FROM sqlite_master WHERE type = 'trigger';")
+    assert "quote_stats_t_insert" in {name for (name,) in dbc.fetchall()}
+
+
+def test_random_quote_gaps(dbc):
+    for n in range(20):
+        quote.db_add_quote(dbc, f"quote {n}", "nick", "adder", "#a")
+    for qcid in range(1, 20):
+        if qcid not in (7, 13):
+            quote.db_delete_channel_quote(dbc, "#a", qcid)
+
+    picked = {quote.db_get_random_quote_from_channel(dbc, "#a")[0]
+              for _ in range(200)}
+    assert picked <= {7, 13, 20}
+    assert len(picked) > 1
+    picked = {quote.db_get_random_channel_quote_for_quotee(dbc, "nick",
+                                                           "#a")[0]
+              for _ in range(200)}
+    assert picked == {7, 13, 20}
+    assert quote.db_get_random_quote_from_channel(dbc, "#b") is None
+
+
+def test_import_own_connection(tmp_path):
+    # quote-import must not depend on the transaction of the shared
+    # connection, which other modules commit or roll back at any time.
+    db = sqlite3.connect(tmp_path / "bot.db")
+    dbc = db.cursor()
+    quote.db_init(dbc)
+    db.commit()
+
+    path = tmp_path / "quotes.jsonl"
+    path.write_text(json.dumps(record("#b", "imported")) + "\n")
+    notices = []
+    msg = types.SimpleNamespace(get_nickname=lambda: "owner",
+                                get_botcmd=lambda: "quote-import",
+                                get_botcmd_prefix=lambda: ".",
+                                get_args=lambda: str(path))
+    irc = types.SimpleNamespace(out=types.SimpleNamespace(
+        notice=lambda target, m: notices.append(m)))
+
+    quote.quote_import(types.SimpleNamespace(msg=msg), irc, dbc)
+    assert notices == [f"{quote.logo}: 1 quotes imported."]
+    db.rollback()  # Another module rolling back its own transaction
+    dbc.execute("SELECT quote FROM quote_quotes;")
+    assert dbc.fetchall() == [("imported",)]
+    db.close()
+
+
+# Query plans
+#
+# The lookups must SEARCH an index. A SCAN means that a query reads a
+# whole table and gets slower as the quotes grow.
+
+def plan(dbc, sql, params=()):
+    dbc.execute("EXPLAIN QUERY PLAN " + sql, params)
+    return [row[3] for row in dbc.fetchall()]
+
+
+def scans(details):
+    # Virtual tables always show as SCAN. FTS5 gives the constraints it
+    # uses after the index number ("=" for the rowid, "M" for MATCH) and
+    # nothing for a full scan.
+    return [d for d in details
+            if d.startswith("SCAN") and d != "SCAN CONSTANT ROW"
+            and not re.search(r"VIRTUAL TABLE INDEX \d+:\S", d)]
+
+
+def traced(dbc, func, *args):
+    """Return the statements that func(dbc, *args) runs."""
+    statements = []
+    dbc.connection.set_trace_callback(statements.append)
+    try:
+        ret = func(dbc, *args)
+        if hasattr(ret, "__next__"):
+            list(ret)
+    finally:
+        dbc.connection.set_trace_callback(None)
+    return [s for s in statements if not s.lstrip().startswith("--")]
+
+
+@pytest.mark.parametrize("func, args", [
+    (quote.db_get_quotes_for_quotee, ("nick",)),
+    (quote.db_get_random_channel_quote_for_quotee, ("nick", "#a")),
+    (quote.db_get_quotes_for_added_by, ("adder",)),
+    (quote.db_get_channel_quotes_for_added_by, ("adder", "#a")),
+    (quote.db_get_random_quote_from_channel, ("#a",)),
+    (quote.db_max_channel_quote_id, ("#a",)),
+    (quote.db_find_by_channel_id, (1, "#a")),
+    (quote.db_delete_channel_quote, ("#a", 1)),
+    (quote.db_stats_top, ("#a", "quotee")),
+    (quote.db_most_viewed, ("#a",)),
+])
+def test_lookup_plans(dbc, func, args):
+    for n in range(3):
+        quote.db_add_quote(dbc, f"quote {n}", "nick", "adder", "#a")
+    statements = traced(dbc, func, *args)
+    assert statements
+    for sql in statements:
+        assert not scans(plan(dbc, sql)), sql
+
+
+@pytest.mark.parametrize("external", [False, True])
+def test_trigger_plans(dbc, external):
+    if external:
+        quote.db_fts5_external(dbc)
+    dbc.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger';")
+    for name, sql in dbc.fetchall():
+        body = sql[sql.index("BEGIN") + 5:sql.rindex("END")]
+        for statement in filter(str.strip, body.split(";")):
+            statement = re.sub(r"\b(old|new)\.\w+", "?", statement)
+            params = (1,) * statement.count("?")
+            assert not scans(plan(dbc, statement, params)), name
+
+
+def test_search_pages_follow_changes(dbc):
+    for n in range(12):
+        quote.db_add_quote(dbc, f"hello world {n}", "nick", "adder", "#a")
+    for page in (1, 2):
+        quote.quote_search_handler(dbc, f"hello world --page {page}",
+                                   "#a", "#a")
+
+    # The bm25 ranks of the cached keys change with the corpus
+    for n in range(40):
+        quote.db_add_quote(dbc, f"unrelated {n}", "nick", "adder", "#a")
+    r = quote.quote_search_handler(dbc, "hello world --page 3", "#a", "#a")
+    assert len(r) == quote.search_page_size + 1
+    assert r[-1].endswith("Page 3. For more use: --page 4")
+
+    quote.db_fts5_external(dbc)
+    r = quote.quote_search_handler(dbc, "hello world --page 10", "#a", "#a")
+    assert r == [f"{quote.logo}: No results"]
+
+
+# ====================================================================
+# Benchmark
+# ====================================================================
+
+# The random picks as they were done before, sorting the rows
+random_order_sql = {
+    "channel": """
+        SELECT c.id, q.quote, q.quotee, q.added_by, q.views, q.id
+        FROM quote_channels AS c
+        INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+        WHERE c.channel = ?
+        ORDER BY RANDOM()
+        LIMIT 1;
+    """,
+    "quotee": """
+        SELECT c.id, q.quote, q.quotee, q.added_by, q.views, q.id
+        FROM quote_channels AS c
+        INNER JOIN quote_quotes AS q ON q.id = c.quote_id
+        WHERE q.quotee = ? AND c.channel = ?
+        ORDER BY RANDOM()
+        LIMIT 1;
+    """,
+}
+
+
+def timed(func, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        func()
+    return (time.perf_counter() - start) / runs
+
+
+def benchmark(quotes=100000, quotees=20):
+    db = sqlite3.connect(":memory:")
+    dbc = db.cursor()
+    quote.db_init(dbc)
+    quote.db_import_quotes(dbc, (
+        record("#bench", f"synthetic quote {n}", quotee=f"nick{n % quotees}")
+        for n in range(quotes)))
+    # Leave the gaps of quote-del behind
+    dbc.executemany("DELETE FROM quote_channels WHERE id = ?;",
+                    ((qcid,) for qcid in range(1, quotes, 37)))
+    db.commit()
+    dbc.execute("ANALYZE;")
+    print(f"{quotes} quotes, {quotes // 37 + 1} deleted,"
+          f" {quotes // quotees} per quotee")
+
+    def nick():
+        return f"nick{random.randrange(quotees)}"
+
+    old = timed(lambda: dbc.execute(random_order_sql["channel"],
+                                    ("#bench",)).fetchone(), 20)
+    new = timed(lambda: quote.db_get_random_quote_from_channel(
+        dbc, "#bench"), 2000)
+    print(f"channel: ORDER BY RANDOM() {old * 1e3:.2f} ms,"
+          f" probe {new * 1e3:.3f} ms")
+
+    old = timed(lambda: dbc.execute(random_order_sql["quotee"],
+                                    (nick(), "#bench")).fetchone(), 20)
+    new = timed(lambda: quote.db_get_random_channel_quote_for_quotee(
+        dbc, nick(), "#bench"), 200)
+    print(f"quotee:  ORDER BY RANDOM() {old * 1e3:.2f} ms,"
+          f" offset pick {new * 1e3:.3f} ms")
+    db.close()
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,178 @@
+# coding=utf-8
+
+# Tests for sed.py: the regular expression guard and the conformance of
+# the substitutions with GNU sed.
+#
+# Run with pytest, or as a script to also time the substitution against
+# calling GNU sed: python3 tests/test_sed.py
+
+import re
+import shutil
+import subprocess
+import time
+
+import pytest
+
+import support  # noqa: F401
+import sed
+
+
+def substitute(cmd, text):
+    args = sed.sed_parse.split(cmd)
+    return sed.sed_substitute(sed.sed_compile(args[1], args[2], args[3]),
+                              text)
+
+
+def gnu_sed(cmd, text):
+    p = subprocess.run(["sed", "-E", "--sandbox", cmd],
+                       input=(text + "\n").encode(), capture_output=True)
+    return p.stdout.decode().rstrip("\n") if p.returncode == 0 else None
+
+
+def has_gnu_sed():
+    if not shutil.which("sed"):
+        return False
+    p = subprocess.run(["sed", "--version"], capture_output=True)
+    return p.returncode == 0 and b"GNU" in p.stdout
+
+
+# ====================================================================
+# Regular expression guard
+# ====================================================================
+
+rejected = [
+    "(a|a)+b", "(a|aa)*b", "(.*a){12}x",  # Backtrack for seconds
+    "(a+)+", "(a*)*b", "(a?)+", "((a|b))+", "(a|b){2,}", "(x+x+)+y",
+    "a*{12}", "a+{2}", "(.*){3}", ".*.*.*.*x",
+    "(a{1,30}){1,30}b", "(a?){25}a{25}", ".*.*.*x",
+]
+
+accepted = [
+    "(ab)+", "(a|b)", "(a|b)?", "(a{2}){3}", "x*yz*", "(ab?)?", "[a|b]+",
+    "(foo|bar) baz", "a+?", "x*+", "a**", "a??",
+]
+
+
+def test_rejected():
+    for regexp in rejected:
+        try:
+            sed.ere_compile(regexp, 0)
+        except re.error:
+            continue
+        raise AssertionError(f"{regexp} was accepted")
+
+
+def test_accepted():
+    for regexp in accepted:
+        sed.ere_compile(regexp, 0)
+
+
+# ====================================================================
+# Translation of POSIX ERE
+# ====================================================================
+
+def test_consecutive_quantifiers():
+    # In ERE a quantifier applies to the quantified atom before it.
+    assert sed.ere_to_re("a+?") == "a*"
+    assert sed.ere_to_re("x*+") == "x*"
+    assert sed.ere_to_re("a**") == "a*"
+    assert sed.ere_to_re("a??") == "a?"
+    assert sed.ere_to_re("a{2}{2}") == "(?:a{2}){2}"
+    assert sed.ere_to_re("(ab)+?") == "(ab)*"
+    assert substitute("s/a+?/X/", "aaa") == "X"
+    assert substitute("s/a*?b/X/", "aab") == "X"
+
+
+def test_invalid_preceding():
+    for regexp in ("*a", "(*a)", "a|*b", "^*"):
+        try:
+            sed.ere_to_re(regexp)
+        except re.error:
+            continue
+        raise AssertionError(f"{regexp} was accepted")
+
+
+# ====================================================================
+# Conformance with GNU sed
+# ====================================================================
+
+# (text, command)
+conformance = [
+    ("hello world", "s/world/there/"), ("hello world", "s/o/0/g"),
+    ("hello world", "s/o/0/2"), ("aaa bbb aaa", "s/a/X/2g"),
+    ("Hello", "s/hello/bye/i"), ("Hello", "s/hello/bye/I"),
+    ("foo bar", "s/(foo) (bar)/\\2 \\1/"), ("foo bar", "s/o+/[&]/g"),
+    ("foo bar", "s/foo/\\&/"), ("baaac", "s/a*/x/g"), ("abc", "s/x*/-/g"),
+    ("abc", "s/b*/-/2"), ("hello world", "s/\\w+/\\u&/g"),
+    ("hello world", "s/.*/\\U&/"),
+    ("HELLO World", "s/(\\w+) (\\w+)/\\L\\1\\E \\2/"),
+    ("abc123def", "s/[[:digit:]]+/N/"), ("abc123def", "s/[^[:alpha:]]/_/g"),
+    ("a.b.c", "s/\\./-/g"), ("a+b", "s/a\\+b/sum/"),
+    ("the cat sat", "s/\\<.at\\>/dog/g"), ("the cat", "s/t$/T/"),
+    ("the cat", "s/^t/T/"), ("x{2}", "s/x\\{2\\}/y/"), ("xx", "s/x{2}/y/"),
+    ("a/b", "s/a\\/b/c/"), ("tab", "s/a/\\t/"), ("abc", "s/b|c/X/g"),
+    ("aaa", "s/a{2,}/Z/"), ("wow  spaces", "s/[[:space:]]+/ /"),
+    ("teh thing", "s/teh/the/"), ("foo-bar", "s/[a-z]-[a-z]/&&/"),
+    ("A]B", "s/[]]/!/"), ("a^b", "s/[b^]/X/g"), ("C:\\dir", "s/[\\\\]/\\//"),
+    ("price 10$", "s/[$]/€/"), ("abc", "s/(a)(b)(c)/\\3\\2\\1/"),
+    ("lower UPPER", "s/[[:upper:]]+/\\L&/"), ("hello", "s/l/L/3"),
+    ("aaaa", "s/a/b/3g"), ("abcabc", "s/(abc)+/X/"), ("a|b", "s/a\\|b/or/"),
+    ("x y z", "s/ /_/gi"), ("emoji 😀 ok", "s/😀/:)/"), ("ünïcödé", "s/ï/i/"),
+    ("snake_case_name", "s/_(.)/\\u\\1/g"), ("a  b", "s/ */-/g"),
+    ("", "s/^/start/"), ("aaa", "s/a+?/X/"), ("aaaa*a*b xx", "s/x*+/X/"),
+    ("aaaa*a*b xx", "s/a**/X/"), ("aaaa b", "s/a{2}{2}/X/"),
+    ("aaab", "s/a??/X/g"), ("ababx", "s/(ab)+?/X/"), ("*a", "s/*a/X/"),
+]
+
+
+def test_conformance():
+    if not has_gnu_sed():
+        pytest.skip("GNU sed is not available")
+
+    mismatches = []
+    for text, cmd in conformance:
+        try:
+            ours = substitute(cmd, text)
+        except re.error:
+            ours = None
+        gnu = gnu_sed(cmd, text)
+        if ours != gnu:
+            mismatches.append((text, cmd, ours, gnu))
+    assert not mismatches, mismatches
+
+
+# ====================================================================
+# Benchmark
+# ====================================================================
+
+def benchmark():
+    text = "the quick brown fox jumps over the lazy dog " * 3
+    cmd = "s/(qu|la)[a-z]+/\\U&/g"
+
+    runs = 20000
+    start = time.perf_counter()
+    for _ in range(runs):
+        substitute(cmd, text)
+    ours = (time.perf_counter() - start) / runs
+    print(f"in-process: {ours * 1e6:.1f} us per substitution")
+
+    if has_gnu_sed():
+        runs = 200
+        start = time.perf_counter()
+        for _ in range(runs):
+            gnu_sed(cmd, text)
+        gnu = (time.perf_counter() - start) / runs
+        print(f"GNU sed:    {gnu * 1e6:.1f} us per substitution")
+
+
+if __name__ == "__main__":
+    tests = [f for name, f in sorted(globals().items())
+             if name.startswith("test_")]
+    for test in tests:
+        try:
+            test()
+        except pytest.skip.Exception as e:
+            print(f"{test.__name__}: skipped, {e}")
+            continue
+        print(f"{test.__name__}: ok")
+    benchmark()
@@ -0,0 +1,100 @@
+# coding=utf-8
+
+# Tests for sqlhelper.py.
+#
+# Run with pytest, or as a script to time the write of one message with
+# INSERT OR IGNORE + UPDATE against the upsert, with and without the
+# connection profile: python3 tests/test_sqlhelper.py
+
+import os
+import sqlite3
+import tempfile
+import time
+
+import pytest
+
+import support  # noqa: F401
+import sqlhelper
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE IF NOT EXISTS seen"
+               " (nick TEXT PRIMARY KEY, msg TEXT, time INTEGER);")
+    return db
+
+
+def test_upsert(tmp_path):
+    db = connect(tmp_path / "bot.db")
+    dbc = db.cursor()
+    sqlhelper.upsert(dbc, "seen", {"nick": "nick"}, {"msg": "a", "time": 1})
+    sqlhelper.upsert(dbc, "seen", {"nick": "nick"}, {"msg": "b", "time": 2})
+    dbc.execute("SELECT * FROM seen;")
+    assert dbc.fetchall() == [("nick", "b", 2)]
+
+
+def test_profile(tmp_path):
+    db = connect(tmp_path / "bot.db")
+    db.execute("INSERT INTO seen VALUES ('nick', 'a', 1);")
+    sqlhelper.use_profile(db)  # In a transaction, applied later
+    assert db.execute("PRAGMA journal_mode;").fetchone() == ("delete",)
+    db.commit()
+    sqlhelper.use_profile(db)
+    assert db.execute("PRAGMA journal_mode;").fetchone() == ("wal",)
+    assert db.execute("PRAGMA synchronous;").fetchone() == (1,)  # NORMAL
+
+
+def test_connect(tmp_path):
+    db = connect(tmp_path / "bot.db")
+    sqlhelper.use_profile(db)
+    other = sqlhelper.connect(db)
+    other.execute("INSERT INTO seen VALUES ('other', 'b', 2);")
+    other.commit()
+    db.execute("INSERT INTO seen VALUES ('nick', 'a', 1);")
+    db.rollback()  # Does not touch the commit of the other connection
+    assert db.execute("SELECT nick FROM seen;").fetchall() == [("other",)]
+
+    with pytest.raises(ValueError):
+        sqlhelper.connect(sqlite3.connect(":memory:"))
+
+
+# ====================================================================
+# Benchmark
+# ====================================================================
+
+def insert_update(dbc, nick, msg, t):
+    # The two statements the modules used before the upsert
+    dbc.execute("INSERT OR IGNORE INTO seen (nick, msg, time)"
+                " VALUES (?, ?, ?);", (nick, msg, t))
+    dbc.execute("UPDATE seen SET msg=?, time=? WHERE nick=?;",
+                (msg, t, nick))
+
+
+def upsert(dbc, nick, msg, t):
+    sqlhelper.upsert(dbc, "seen", {"nick": nick}, {"msg": msg, "time": t})
+
+
+def benchmark(messages=2000, nicks=50):
+    cases = [
+        ("INSERT OR IGNORE + UPDATE, default journal", insert_update, False),
+        ("upsert, default journal", upsert, False),
+        ("upsert, WAL + synchronous=NORMAL", upsert, True),
+    ]
+    for name, write, profile in cases:
+        with tempfile.TemporaryDirectory() as tmp:
+            db = connect(os.path.join(tmp, "bot.db"))
+            if profile:
+                sqlhelper.use_profile(db)
+            dbc = db.cursor()
+            # One commit per message, as the bot does after each one
+            start = time.perf_counter()
+            for n in range(messages):
+                write(dbc, f"nick{n % nicks}", f"message {n}", n)
+                db.commit()
+            elapsed = (time.perf_counter() - start) / messages
+            db.close()
+        print(f"{name:44} {elapsed * 1e6:6.1f} us per message")
+
+
+if __name__ == "__main__":
+    benchmark()
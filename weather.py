@@ -29,6 +29,7 @@ import urllib.parse
 import requests
 from user_auth import user_auth
 from admin import is_bot_owner
+from sqlhelper import upsert, use_profile
 
 class Module:
     startup = True
@@ -72,6 +73,7 @@ class Module:
 
 def db_init(i, _irc):
     db = i.db_disk
+    use_profile(db)
     dbc = db.cursor()
 
     dbc.executescript("""
@@ -368,13 +370,7 @@ def toggle_auth(dbc, nickname):
     elif auth == 1:
         auth = 0
 
-    dbc.execute("""
-    INSERT OR IGNORE INTO weather (nickname, auth) VALUES (?, ?);
-    """, (nickname, auth))
-
-    dbc.execute("""
-    UPDATE weather SET auth=? WHERE nickname=?;
-    """, (auth, nickname))
+    upsert(dbc, "weather", {"nickname": nickname}, {"auth": auth})
 
     return auth
 
@@ -400,13 +396,7 @@ def get_auth(i, irc, dbc):
 # Location
 
 def set_location(dbc, nickname, location):
-    dbc.execute("""
-    INSERT OR IGNORE INTO weather (nickname, location) VALUES (?, ?);
-    """, (nickname, location))
-
-    dbc.execute("""
-    UPDATE weather SET location=? WHERE nickname=?;
-    """, (location, nickname))
+    upsert(dbc, "weather", {"nickname": nickname}, {"location": location})
 
 
 def get_location(dbc, nickname):